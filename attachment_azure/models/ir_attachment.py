@@ -1,10 +1,12 @@
 # Copyright 2016-2019 Camptocamp SA
 # Copyright 2021 Open Source Integrators
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
-import io
 import logging
 import os
 import re
+import threading
+import time
+from collections import defaultdict
 from datetime import datetime, timedelta
 
 from odoo import _, api, exceptions, models
@@ -27,6 +29,83 @@ try:
 except ImportError:
     _logger.debug("Cannot 'import azure-identity'.")
 
+# HTTP status returned by Azure when it throttles the requests
+THROTTLING_STATUS_CODES = (429, 503)
+# validity of the generated Shared Access Signatures
+SAS_VALIDITY = timedelta(hours=1)
+# a new Shared Access Signature is generated when the current one expires in
+# less than this delay
+SAS_REFRESH_MARGIN = timedelta(minutes=10)
+# maximum number of blobs deleted by a batch request
+DELETE_BATCH_SIZE = 256
+# number of blobs returned by each request of a listing
+LIST_PAGE_SIZE = 5000
+# maximum time in seconds to wait for an asynchronous copy of a blob
+COPY_TIMEOUT = 600
+# transfer options of the blob service clients and the environment variables
+# to configure them (in bytes), the defaults of azure-storage-blob are used
+# when they are not set
+TRANSFER_OPTIONS = {
+    "max_block_size": "AZURE_STORAGE_MAX_BLOCK_SIZE",
+    "max_single_put_size": "AZURE_STORAGE_MAX_SINGLE_PUT_SIZE",
+    "max_chunk_get_size": "AZURE_STORAGE_MAX_CHUNK_GET_SIZE",
+    "max_single_get_size": "AZURE_STORAGE_MAX_SINGLE_GET_SIZE",
+}
+
+
+class AzureClientStore(object):
+    """Keep in memory the Azure blob service clients per process
+
+    Building a ``BlobServiceClient`` creates a new connection pool, and
+    depending on the configuration, generates a new account SAS or a new
+    ``DefaultAzureCredential`` which fetches a token over the network.
+    Instead of doing it on every operation, the clients are kept for each
+    configuration, until their SAS is about to expire.
+
+    The containers known to exist are kept as well so their existence is
+    checked only once per process.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._containers = set()
+        self._lock = threading.Lock()
+
+    def _is_valid(self, entry):
+        if entry is None:
+            return False
+        expiry = entry[1]
+        return not expiry or datetime.utcnow() + SAS_REFRESH_MARGIN < expiry
+
+    def get_client(self, key, factory):
+        """Return the client for ``key``
+
+        ``factory`` is called to build a new client, it returns the client
+        and its expiry date (or None when it does not expire).
+        """
+        entry = self._clients.get(key)
+        if not self._is_valid(entry):
+            with self._lock:
+                entry = self._clients.get(key)
+                if not self._is_valid(entry):
+                    entry = factory()
+                    self._clients[key] = entry
+        return entry[0]
+
+    def is_known_container(self, container_client):
+        return (
+            container_client.account_name,
+            container_client.container_name,
+        ) in self._containers
+
+    def add_known_container(self, container_client):
+        self._containers.add(
+            (container_client.account_name, container_client.container_name)
+        )
+
+
+azure_client_store = AzureClientStore()
+
 
 class IrAttachment(models.Model):
     _inherit = "ir.attachment"
@@ -70,16 +149,57 @@ class IrAttachment(models.Model):
                 "* AZURE_STORAGE_USE_AAD\n"
             )
             raise exceptions.UserError(msg)
-        blob_service_client = None
+        return azure_client_store.get_client(
+            (connect_str, account_name, account_url, account_key, account_use_aad),
+            lambda: self._new_blob_service_client(
+                connect_str, account_name, account_url, account_key, account_use_aad
+            ),
+        )
+
+    @api.model
+    def _get_azure_transfer_options(self):
+        """Return the transfer options of the blob service clients
+
+        Blobs larger than ``max_single_put_size`` are uploaded in blocks of
+        ``max_block_size`` and blobs larger than ``max_single_get_size`` are
+        downloaded in chunks of ``max_chunk_get_size``, the blocks and chunks
+        being transferred by ``AZURE_STORAGE_MAX_CONCURRENCY`` parallel
+        connections.
+        """
+        options = {}
+        for option, env_var in TRANSFER_OPTIONS.items():
+            if os.environ.get(env_var):
+                options[option] = int(os.environ[env_var])
+        return options
+
+    @api.model
+    def _get_azure_max_concurrency(self):
+        return int(os.environ.get("AZURE_STORAGE_MAX_CONCURRENCY") or 1)
+
+    @api.model
+    def _get_azure_copy_timeout(self):
+        return int(os.environ.get("AZURE_STORAGE_COPY_TIMEOUT") or COPY_TIMEOUT)
+
+    @api.model
+    def _new_blob_service_client(
+        self, connect_str, account_name, account_url, account_key, account_use_aad
+    ):
+        """Build a new blob service client
+
+        Return the client and the expiry date of its credential, or None
+        when it does not expire (the AAD credential renews its tokens).
+        """
+        expiry = None
+        options = self._get_azure_transfer_options()
         if account_use_aad:
             token_credential = DefaultAzureCredential()
             blob_service_client = BlobServiceClient(
-                account_url=account_url, credential=token_credential
+                account_url=account_url, credential=token_credential, **options
             )
         elif connect_str:
             try:
                 blob_service_client = BlobServiceClient.from_connection_string(
-                    connect_str
+                    connect_str, **options
                 )
             except HttpResponseError as error:
                 _logger.exception(
@@ -89,16 +209,20 @@ class IrAttachment(models.Model):
                 raise exceptions.UserError(str(error)) from None
         else:
             try:
+                expiry = datetime.utcnow() + SAS_VALIDITY
                 sas_token = generate_account_sas(
                     account_name=account_name,
                     account_key=account_key,
                     resource_types=ResourceTypes(container=True, object=True),
-                    permission=AccountSasPermissions(read=True, write=True),
-                    expiry=datetime.utcnow() + timedelta(hours=1),
+                    permission=AccountSasPermissions(
+                        read=True, write=True, delete=True, list=True
+                    ),
+                    expiry=expiry,
                 )
                 blob_service_client = BlobServiceClient(
                     account_url=account_url,
                     credential=sas_token,
+                    **options,
                 )
             except HttpResponseError as error:
                 _logger.exception(
@@ -106,7 +230,7 @@ class IrAttachment(models.Model):
                     "Access Signature (SAS)"
                 )
                 raise exceptions.UserError(str(error)) from None
-        return blob_service_client
+        return blob_service_client, expiry
 
     @api.model
     def _get_container_name(self):
@@ -133,6 +257,8 @@ class IrAttachment(models.Model):
             )
             return False
         container_client = blob_service_client.get_container_client(container_name)
+        if azure_client_store.is_known_container(container_client):
+            return container_client
         if not container_client.exists():
             try:
                 # Create the container
@@ -140,8 +266,52 @@ class IrAttachment(models.Model):
             except HttpResponseError as error:
                 _logger.exception("Error during the creation of the Azure container")
                 raise exceptions.UserError(str(error)) from None
+        azure_client_store.add_known_container(container_client)
         return container_client
 
+    @api.model
+    def _get_store_clone_copier(self, storage):
+        if storage != "azure":
+            return super()._get_store_clone_copier(storage)
+        blob_service_client = self._get_blob_service_client()
+        container_client = self._get_azure_container()
+        timeout = self._get_azure_copy_timeout()
+
+        def copy(fname):
+            key = fname.replace("azure://", "", 1).lower()
+            container_name, key = key.split("/", 1)
+            if container_name == container_client.container_name:
+                return fname
+            source_blob_client = blob_service_client.get_blob_client(
+                container_name, key
+            )
+            blob_client = container_client.get_blob_client(key)
+            try:
+                copy_props = blob_client.start_copy_from_url(source_blob_client.url)
+                copy_status = copy_props["copy_status"]
+                # copies inside a storage account are synchronous, copies
+                # between accounts might need to be waited for
+                deadline = time.monotonic() + timeout
+                while copy_status == "pending":
+                    if time.monotonic() > deadline:
+                        blob_client.abort_copy(copy_props["copy_id"])
+                        raise RuntimeError(
+                            "Copy of %s aborted after %ss" % (fname, timeout)
+                        )
+                    time.sleep(1)
+                    copy_status = blob_client.get_blob_properties().copy.status
+            except HttpResponseError as error:
+                if error.status_code in THROTTLING_STATUS_CODES:
+                    self._storage_pushback()
+                raise
+            if copy_status != "success":
+                raise RuntimeError(
+                    "Copy of %s ended with status %s" % (fname, copy_status)
+                )
+            return "azure://%s/%s" % (container_client.container_name, key)
+
+        return copy
+
     @api.model
     def _store_file_read(self, fname, bin_size=False):
         if fname.startswith("azure://"):
@@ -156,9 +326,14 @@ class IrAttachment(models.Model):
                 return ""
             try:
                 blob_client = container_client.get_blob_client(key)
-                read = blob_client.download_blob().readall()
-            except HttpResponseError:
+                read = blob_client.download_blob(
+                    max_concurrency=self._get_azure_max_concurrency()
+                ).readall()
+            except HttpResponseError as error:
                 read = ""
+                if error.status_code in THROTTLING_STATUS_CODES:
+                    if self._storage_pushback():
+                        raise
                 _logger.info("Attachment '%s' missing on object storage", fname)
             return read
         else:
@@ -170,24 +345,28 @@ class IrAttachment(models.Model):
         if location == "azure":
             container_client = self._get_azure_container()
             filename = "azure://%s/%s" % (container_client.container_name, key)
-            with io.BytesIO() as file:
-                blob_client = container_client.get_blob_client(key.lower())
-                file.write(bin_data)
-                file.seek(0)
-                try:
-                    blob_client.upload_blob(file, blob_type="BlockBlob")
-                except ResourceExistsError:
-                    _logger.exception(
-                        "Trying to re create an existing resource %s" % filename
-                    )
-                except HttpResponseError as error:
-                    # log verbose error from azure, return short message for user
-                    _logger.exception(
-                        "HTTP Error during storage of the file %s" % filename
-                    )
-                    raise exceptions.UserError(
-                        _("The file could not be stored: %s") % str(error)
-                    ) from None
+            blob_client = container_client.get_blob_client(key.lower())
+            try:
+                # the data is given as is, the client splits it in blocks
+                # above max_single_put_size without copying it
+                blob_client.upload_blob(
+                    bin_data,
+                    blob_type="BlockBlob",
+                    length=len(bin_data),
+                    max_concurrency=self._get_azure_max_concurrency(),
+                )
+            except ResourceExistsError:
+                _logger.exception(
+                    "Trying to re create an existing resource %s" % filename
+                )
+            except HttpResponseError as error:
+                if error.status_code in THROTTLING_STATUS_CODES:
+                    self._storage_pushback()
+                # log verbose error from azure, return short message for user
+                _logger.exception("HTTP Error during storage of the file %s" % filename)
+                raise exceptions.UserError(
+                    _("The file could not be stored: %s") % str(error)
+                ) from None
         else:
             _super = super(IrAttachment, self)
             filename = _super._store_file_write(key, bin_data)
@@ -216,3 +395,75 @@ class IrAttachment(models.Model):
                 _logger.exception("Error during deletion of the file %s" % fname)
         else:
             super(IrAttachment, self)._store_file_delete(fname)
+
+    @api.model
+    def _store_file_delete_many(self, fnames, file_sizes=None):
+        keys_by_container = defaultdict(list)
+        other_fnames = []
+        for fname in fnames:
+            if not fname.startswith("azure://"):
+                other_fnames.append(fname)
+                continue
+            key = fname.replace("azure://", "", 1).lower()
+            if "/" in key:
+                container_name, key = key.split("/", 1)
+            else:
+                container_name = None
+            keys_by_container[container_name].append(key)
+        if other_fnames:
+            super(IrAttachment, self)._store_file_delete_many(
+                other_fnames, file_sizes=file_sizes
+            )
+        for container_name, keys in keys_by_container.items():
+            container_client = self._get_azure_container(container_name)
+            if not container_client:
+                continue
+            for index in range(0, len(keys), DELETE_BATCH_SIZE):
+                batch = keys[index : index + DELETE_BATCH_SIZE]
+                try:
+                    responses = container_client.delete_blobs(
+                        *batch, raise_on_any_failure=False
+                    )
+                except HttpResponseError:
+                    _logger.exception(
+                        "Error during deletion of %d files in %s",
+                        len(batch),
+                        container_client.container_name,
+                    )
+                    continue
+                for key, response in zip(batch, responses):
+                    # a blob already deleted is not an error
+                    if response.status_code not in (202, 404):
+                        _logger.error(
+                            "Error during deletion of the file azure://%s/%s: "
+                            "HTTP %s",
+                            container_client.container_name,
+                            key,
+                            response.status_code,
+                        )
+                _logger.info("%d files deleted on the object storage", len(batch))
+
+    @api.model
+    def _store_list_files(self, storage, prefix=""):
+        if storage != "azure":
+            yield from super(IrAttachment, self)._store_list_files(
+                storage, prefix=prefix
+            )
+            return
+        container_client = self._get_azure_container()
+        if not container_client:
+            return
+        # the pages are requested lazily while iterating
+        blobs = container_client.list_blobs(
+            name_starts_with=prefix or None, results_per_page=LIST_PAGE_SIZE
+        )
+        try:
+            for blob in blobs:
+                yield "azure://%s/%s" % (container_client.container_name, blob.name)
+        except HttpResponseError as error:
+            if error.status_code in THROTTLING_STATUS_CODES:
+                self._storage_pushback()
+            _logger.exception(
+                "Error while listing the blobs of the container %s",
+                container_client.container_name,
+            )
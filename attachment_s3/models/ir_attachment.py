@@ -2,9 +2,14 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
 
+import functools
+import hashlib
 import io
 import logging
 import os
+import re
+import threading
+import time
 from urllib.parse import urlsplit
 
 from odoo import _, api, exceptions, models
@@ -15,13 +20,127 @@ _logger = logging.getLogger(__name__)
 
 try:
     import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
     from botocore.exceptions import ClientError, EndpointConnectionError
 except ImportError:
     boto3 = None  # noqa
+    Config = None  # noqa
+    TransferConfig = None  # noqa
     ClientError = None  # noqa
     EndpointConnectionError = None  # noqa
     _logger.debug("Cannot 'import boto3'.")
 
+# keys computed from the checksum of the files
+CHECKSUM_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+# error codes returned by S3 when the object does not exist
+MISSING_ERROR_CODES = ("404", "NoSuchKey")
+# error codes returned by S3 providers when they throttle the requests
+THROTTLING_ERROR_CODES = (
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequests",
+    "429",
+    "503",
+)
+
+
+class S3BucketStore(object):
+    """Keep in memory the S3 buckets per process
+
+    Building a boto3 resource costs tens of milliseconds and a new
+    connection pool, and checking that the bucket exists costs a round
+    trip. Instead of doing it on every operation, the buckets are kept
+    for each combination of credentials, endpoint and bucket name. Their
+    existence is checked (and they are created if needed) only when they
+    are used for the first time.
+
+    boto3 resources are not thread-safe, but their clients are: the
+    resources and buckets are only built under a lock, then the
+    operations go through ``bucket.meta.client``.
+    """
+
+    def __init__(self):
+        self._resources = {}
+        self._buckets = {}
+        self._transfer_config = None
+        self._lock = threading.Lock()
+
+    def get_transfer_config(self):
+        """Return the configuration of the managed uploads
+
+        Files larger than the multipart threshold are uploaded in parts
+        of the multipart chunk size, with up to max concurrency parts
+        uploaded in parallel.
+        """
+        if self._transfer_config is None:
+            self._transfer_config = TransferConfig(
+                multipart_threshold=int(
+                    os.environ.get("AWS_TRANSFER_MULTIPART_THRESHOLD")
+                    or 8 * 1024 * 1024
+                ),
+                multipart_chunksize=int(
+                    os.environ.get("AWS_TRANSFER_MULTIPART_CHUNKSIZE")
+                    or 8 * 1024 * 1024
+                ),
+                max_concurrency=int(
+                    os.environ.get("AWS_TRANSFER_MAX_CONCURRENCY") or 10
+                ),
+            )
+        return self._transfer_config
+
+    def _get_resource(self, params):
+        key = tuple(sorted(params.items()))
+        resource = self._resources.get(key)
+        if resource is None:
+            config = Config(
+                max_pool_connections=int(
+                    os.environ.get("AWS_MAX_POOL_CONNECTIONS") or 10
+                ),
+            )
+            session = boto3.session.Session()
+            resource = session.resource("s3", config=config, **params)
+            self._resources[key] = resource
+        return resource
+
+    def _init_bucket(self, s3, bucket_name, region_name=None):
+        exists = True
+        try:
+            s3.meta.client.head_bucket(Bucket=bucket_name)
+        except ClientError as e:
+            # If a client error is thrown, then check that it was a 404 error.
+            # If it was a 404 error, then the bucket does not exist.
+            error_code = e.response["Error"]["Code"]
+            if error_code == "404":
+                exists = False
+        if not exists:
+            if not region_name:
+                return s3.create_bucket(Bucket=bucket_name)
+            return s3.create_bucket(
+                Bucket=bucket_name,
+                CreateBucketConfiguration={"LocationConstraint": region_name},
+            )
+        return s3.Bucket(bucket_name)
+
+    def get_bucket(self, bucket_name, **params):
+        key = (bucket_name, tuple(sorted(params.items())))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    s3 = self._get_resource(params)
+                    bucket = self._init_bucket(
+                        s3, bucket_name, region_name=params.get("region_name")
+                    )
+                    self._buckets[key] = bucket
+        return bucket
+
+
+s3_bucket_store = S3BucketStore()
+
 
 class IrAttachment(models.Model):
     _inherit = "ir.attachment"
@@ -39,6 +158,7 @@ class IrAttachment(models.Model):
         * ``AWS_ACCESS_KEY_ID``
         * ``AWS_SECRET_ACCESS_KEY``
         * ``AWS_BUCKETNAME``
+        * ``AWS_MAX_POOL_CONNECTIONS``
 
         If a name is provided, we'll read this bucket, otherwise, the bucket
         from the environment variable ``AWS_BUCKETNAME`` will be read.
@@ -79,32 +199,169 @@ class IrAttachment(models.Model):
             ).format(bucket_name=bucket_name)
 
             raise exceptions.UserError(msg)
-        # try:
-        s3 = boto3.resource("s3", **params)
-        bucket = s3.Bucket(bucket_name)
-        exists = True
         try:
-            s3.meta.client.head_bucket(Bucket=bucket_name)
-        except ClientError as e:
-            # If a client error is thrown, then check that it was a 404 error.
-            # If it was a 404 error, then the bucket does not exist.
-            error_code = e.response["Error"]["Code"]
-            if error_code == "404":
-                exists = False
+            return s3_bucket_store.get_bucket(bucket_name, **params)
         except EndpointConnectionError as error:
             # log verbose error from s3, return short message for user
-            msg = _logger.exception("Error during connection on S3")
+            _logger.exception("Error during connection on S3")
             raise exceptions.UserError(str(error)) from None
 
-        if not exists:
-            if not region_name:
-                bucket = s3.create_bucket(Bucket=bucket_name)
-            else:
-                bucket = s3.create_bucket(
-                    Bucket=bucket_name,
-                    CreateBucketConfiguration={"LocationConstraint": region_name},
+    @api.model
+    def _s3_key_fanout_levels(self):
+        """Return the number of fan-out levels of the keys
+
+        S3 providers partition the buckets on the prefix of the keys: keys
+        sharing a common prefix (``storage_path/filename`` of FileURL fields,
+        ...) are not spread evenly and bulk imports get throttled. The
+        environment variable ``AWS_KEY_FANOUT_LEVELS`` gives the number of
+        2-hexadecimal-chars levels put in front of the keys, taken from the
+        checksum (or from the sha1 of the key when it is not a checksum):
+        with 2 levels, ``d3b1...`` becomes ``d3/b1/d3b1...``.
+        """
+        return int(os.environ.get("AWS_KEY_FANOUT_LEVELS") or 0)
+
+    @api.model
+    def _s3_key_prefix(self, key, levels):
+        if CHECKSUM_KEY_RE.match(key):
+            digest = key
+        else:
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return "".join("%s/" % digest[i * 2 : i * 2 + 2] for i in range(levels))
+
+    @api.model
+    def _s3_layout_key(self, key):
+        """Return the key used to store an object in the configured layout
+
+        A key which already is in the layout is returned unchanged.
+        """
+        levels = self._s3_key_fanout_levels()
+        if not levels:
+            return key
+        parts = key.split("/", levels)
+        if len(parts) > levels:
+            base_key = parts[-1]
+            if key == self._s3_key_prefix(base_key, levels) + base_key:
+                return key
+        return self._s3_key_prefix(key, levels) + key
+
+    @api.model
+    def _s3_copy_object(self, bucket, key, new_key):
+        """Copy an object on the server side, no data goes through Odoo"""
+        try:
+            bucket.meta.client.copy(
+                {"Bucket": bucket.name, "Key": key},
+                bucket.name,
+                new_key,
+                Config=s3_bucket_store.get_transfer_config(),
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] in THROTTLING_ERROR_CODES:
+                self._storage_pushback()
+            raise
+
+    @api.model
+    def _get_store_clone_copier(self, storage):
+        if storage != "s3":
+            return super()._get_store_clone_copier(storage)
+        bucket = self._get_s3_bucket()
+
+        def copy(fname):
+            s3uri = S3Uri(fname)
+            if s3uri.bucket() == bucket.name:
+                return fname
+            key = s3uri.item()
+            try:
+                bucket.meta.client.copy(
+                    {"Bucket": s3uri.bucket(), "Key": key},
+                    bucket.name,
+                    key,
+                    Config=s3_bucket_store.get_transfer_config(),
                 )
-        return bucket
+            except ClientError as error:
+                if error.response["Error"]["Code"] in THROTTLING_ERROR_CODES:
+                    self._storage_pushback()
+                raise
+            return "s3://%s/%s" % (bucket.name, key)
+
+        return copy
+
+    @api.model
+    def force_s3_key_layout(self, new_cr=False):
+        """Move the objects of the current bucket to the configured key layout
+
+        The objects are copied on the server side to their new key, the
+        attachments are updated, then the former objects are deleted. The
+        objects of other buckets (e.g. production bucket read from a
+        replication) are not touched. The bulk operations limits of
+        ``base_attachment_object_storage`` apply.
+
+        It is not called anywhere, but can be called by RPC or scripts.
+        """
+        if not self.env["res.users"].browse(self.env.uid)._is_admin():
+            raise exceptions.AccessError(
+                _("Only administrators can execute this action.")
+            )
+        if self.is_storage_disabled("s3"):
+            return
+        bucket = self._get_s3_bucket()
+        prefix = "s3://%s/" % bucket.name
+        with self.do_in_new_env(new_cr=new_cr) as new_env:
+            throttle = new_env["ir.attachment"]._get_storage_throttle()
+            model_env = new_env["ir.attachment"].with_context(storage_throttle=throttle)
+            new_env.cr.execute(
+                "SELECT DISTINCT store_fname FROM ir_attachment "
+                "WHERE store_fname LIKE %s",
+                (prefix + "%",),
+            )
+            fnames = [row[0] for row in new_env.cr.fetchall()]
+            total = len(fnames)
+            start_time = time.time()
+            _logger.info("Moving %d objects to the new S3 key layout", total)
+            for current, fname in enumerate(fnames, 1):
+                key = S3Uri(fname).item()
+                new_key = model_env._s3_layout_key(key)
+                if new_key == key:
+                    continue
+                try:
+                    throttle.call(
+                        functools.partial(
+                            model_env._s3_copy_object, bucket, key, new_key
+                        )
+                    )
+                except ClientError:
+                    _logger.exception("Could not move %s to %s", fname, new_key)
+                    continue
+                # several attachments can share the same file
+                new_env.cr.execute(
+                    "UPDATE ir_attachment SET store_fname = %s "
+                    "WHERE store_fname = %s",
+                    (prefix + new_key, fname),
+                )
+                # the former object is deleted only once the new key is
+                # committed in ir.attachment
+                new_env.cr.commit()
+                # an attachment may have been created with the former key
+                # since the UPDATE (e.g. a copy in a concurrent transaction):
+                # keep the object, a next run moves it
+                new_env.cr.execute(
+                    "SELECT COUNT(*) FROM ir_attachment WHERE store_fname = %s",
+                    (fname,),
+                )
+                if new_env.cr.fetchone()[0]:
+                    _logger.info("%s is still used after its move, not deleted", fname)
+                    continue
+                try:
+                    bucket.meta.client.delete_object(Bucket=bucket.name, Key=key)
+                except ClientError:
+                    _logger.exception("Error during deletion of the file %s", fname)
+                if current % 100 == 0 or total - current == 0:
+                    _logger.info(
+                        "object %s/%s after %.2fs",
+                        current,
+                        total,
+                        time.time() - start_time,
+                    )
+            model_env.invalidate_model(["store_fname"])
 
     @api.model
     def _store_file_read(self, fname):
@@ -118,15 +375,24 @@ class IrAttachment(models.Model):
                 )
                 return ""
             try:
-                key = s3uri.item()
-                bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
-                with io.BytesIO() as res:
-                    bucket.download_fileobj(key, res)
-                    res.seek(0)
-                    read = res.read()
-            except ClientError:
+                # a single GET: a managed download would send a HEAD
+                # request first to know the size of the object
+                response = bucket.meta.client.get_object(
+                    Bucket=bucket.name, Key=s3uri.item()
+                )
+                read = response["Body"].read()
+            except ClientError as error:
                 read = ""
-                _logger.info("attachment '%s' missing on object storage", fname)
+                error_code = error.response["Error"]["Code"]
+                if error_code in MISSING_ERROR_CODES:
+                    _logger.info("attachment '%s' missing on object storage", fname)
+                else:
+                    if error_code in THROTTLING_ERROR_CODES:
+                        if self._storage_pushback():
+                            raise
+                    _logger.exception(
+                        "error reading attachment '%s' from object storage", fname
+                    )
             return read
         else:
             return super()._store_file_read(fname)
@@ -136,14 +402,21 @@ class IrAttachment(models.Model):
         location = self.env.context.get("storage_location") or self._storage()
         if location == "s3":
             bucket = self._get_s3_bucket()
-            obj = bucket.Object(key=key)
+            key = self._s3_layout_key(key)
             with io.BytesIO() as file:
                 file.write(bin_data)
                 file.seek(0)
                 filename = "s3://%s/%s" % (bucket.name, key)
                 try:
-                    obj.upload_fileobj(file)
+                    bucket.meta.client.upload_fileobj(
+                        file,
+                        bucket.name,
+                        key,
+                        Config=s3_bucket_store.get_transfer_config(),
+                    )
                 except ClientError as error:
+                    if error.response["Error"]["Code"] in THROTTLING_ERROR_CODES:
+                        self._storage_pushback()
                     # log verbose error from s3, return short message for user
                     _logger.exception("Error during storage of the file %s" % filename)
                     raise exceptions.UserError(
@@ -164,10 +437,10 @@ class IrAttachment(models.Model):
             # otherwise, we might delete files used on a different environment
             if bucket_name == os.environ.get("AWS_BUCKETNAME"):
                 bucket = self._get_s3_bucket()
-                obj = bucket.Object(key=item_name)
                 try:
-                    bucket.meta.client.head_object(Bucket=bucket.name, Key=item_name)
-                    obj.delete()
+                    # deleting a missing object is not an error on S3, no need
+                    # to check its existence first
+                    bucket.meta.client.delete_object(Bucket=bucket.name, Key=item_name)
                     _logger.info("file %s deleted on the object storage" % (fname,))
                 except ClientError:
                     # log verbose error from s3, return short message for
@@ -2,8 +2,13 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
 
+import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 from odoo import _, api, exceptions, models
 
@@ -22,8 +27,20 @@ except ImportError:
     ClientException = None
     _logger.debug("Cannot 'import swiftclient'.")
 
+try:
+    from prometheus_client import Counter, Gauge
+except ImportError:
+    Counter = Gauge = None
+    _logger.debug("Cannot 'import prometheus_client'.")
+
 
 SWIFT_TIMEOUT = 15
+# HTTP status returned by Swift when it throttles the requests
+THROTTLING_STATUS_CODES = (429, 498, 503)
+# objects larger than a segment are uploaded as Static Large Objects
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+# maximum number of objects deleted by a bulk-delete request
+BULK_DELETE_SIZE = 1000
 
 
 class SwiftSessionStore(object):
@@ -34,45 +51,148 @@ class SwiftSessionStore(object):
     operations rejected with an HTTP error code 429.
 
     Swift connections can reuse the same session by asking a session
-    matching their connection parameters with ``get_session``.
+    matching their connection parameters with ``get_session``. The
+    sessions are created under a lock, so concurrent threads never
+    authenticate more than once.
 
     The keystoneauth1's session automatically creates a new token
-    if the previous one is expired.
+    if the previous one is expired. In addition, a background thread
+    renews the tokens which expire in less than ``refresh_margin``
+    seconds, so the requests never wait for the authentication.
 
     The best documentation I found about sessions is
     https://docs.openstack.org/keystoneauth/latest/using-sessions.html
     """
 
+    refresh_interval = 60
+    refresh_margin = 300
+
     def __init__(self):
         self._sessions = {}
+        self._auth_times = {}
+        self._lock = threading.Lock()
+        self._refresher_pid = None
+        self.auth_calls = 0
 
     def _get_key(self, auth_url, username, password, project_name):
         return (auth_url, username, password, project_name)
 
+    def _count_auth(self, key, get_auth_ref):
+        def counted_get_auth_ref(session, **kwargs):
+            auth_ref = get_auth_ref(session, **kwargs)
+            self.auth_calls += 1
+            self._auth_times[key] = time.time()
+            if SWIFT_AUTH_CALLS is not None:
+                SWIFT_AUTH_CALLS.inc()
+            return auth_ref
+
+        return counted_get_auth_ref
+
     def get_session(
         self, auth_url=None, username=None, password=None, project_name=None
     ):
         key = self._get_key(auth_url, username, password, project_name)
         session = self._sessions.get(key)
         if not session:
-            auth = keystoneauth1.identity.v3.Password(
-                username=username,
-                password=password,
-                project_name=project_name,
-                auth_url=auth_url,
-                project_domain_id="default",
-                user_domain_id="default",
-            )
-            session = keystoneauth1.session.Session(
-                auth=auth,
-                timeout=SWIFT_TIMEOUT,
-            )
-            self._sessions[key] = session
+            with self._lock:
+                session = self._sessions.get(key)
+                if not session:
+                    auth = keystoneauth1.identity.v3.Password(
+                        username=username,
+                        password=password,
+                        project_name=project_name,
+                        auth_url=auth_url,
+                        project_domain_id="default",
+                        user_domain_id="default",
+                    )
+                    auth.get_auth_ref = self._count_auth(key, auth.get_auth_ref)
+                    session = keystoneauth1.session.Session(
+                        auth=auth,
+                        timeout=SWIFT_TIMEOUT,
+                    )
+                    self._sessions[key] = session
+        self._ensure_refresher()
         return session
 
+    def token_age(self):
+        """Age in seconds of the oldest token"""
+        if not self._auth_times:
+            return 0
+        return time.time() - min(self._auth_times.values())
+
+    def _ensure_refresher(self):
+        # the thread is started in each worker process, after the fork
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            thread = threading.Thread(
+                target=self._refresh_loop, name="swift-token-refresher", daemon=True
+            )
+            thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            self.refresh_tokens()
+
+    def refresh_tokens(self):
+        """Renew the tokens which will expire soon"""
+        for session in list(self._sessions.values()):
+            auth = session.auth
+            auth_ref = auth.auth_ref
+            # no token yet or invalidated: it will be fetched on next use
+            if auth_ref is None or not auth_ref.will_expire_soon(self.refresh_margin):
+                continue
+            try:
+                # the current token stays in use until the new one replaces it
+                auth.auth_ref = auth.get_auth_ref(session)
+            except Exception:
+                _logger.exception("Could not renew the Swift token")
+
 
 swift_session_store = SwiftSessionStore()
 
+if Counter is not None:
+    SWIFT_AUTH_CALLS = Counter(
+        "swift_auth_calls", "Authentications on the Swift object store"
+    )
+    SWIFT_TOKEN_AGE = Gauge(
+        "swift_token_age_sec", "Age in sec of the oldest Swift auth token"
+    )
+    SWIFT_TOKEN_AGE.set_function(swift_session_store.token_age)
+else:
+    SWIFT_AUTH_CALLS = SWIFT_TOKEN_AGE = None
+
+
+class SwiftConnectionStore(threading.local):
+    """Keep in memory the Swift connections of the current thread
+
+    Creating a ``swiftclient.Connection`` for every operation opens a new
+    HTTP connection each time. The connections are not thread-safe, so
+    each thread (or greenlet with gevent) keeps its own connections, which
+    are reused by all its operations.
+    """
+
+    def __init__(self):
+        self._connections = {}
+
+    def get_connection(self, key, factory):
+        conn = self._connections.get(key)
+        if conn is None:
+            conn = self._connections[key] = factory()
+        return conn
+
+    def clear(self):
+        self._connections.clear()
+
+
+swift_connection_store = SwiftConnectionStore()
+# containers known to exist in the process, so they are created only once
+swift_known_containers = set()
+
 
 class IrAttachment(models.Model):
     _inherit = "ir.attachment"
@@ -112,15 +232,53 @@ class IrAttachment(models.Model):
                 project_name=project_name,
                 auth_url=host,
             )
-            conn = swiftclient.client.Connection(
-                session=session,
-                os_options=os_options,
+            conn = swift_connection_store.get_connection(
+                (host, account, password, project_name, region),
+                lambda: swiftclient.client.Connection(
+                    session=session,
+                    os_options=os_options,
+                ),
             )
         except ClientException:
             _logger.exception("Error connecting to Swift object store")
             raise exceptions.UserError(_("Error on Swift connection")) from None
         return conn
 
+    @api.model
+    def _ensure_swift_container(self, conn, container):
+        """Create the container if it is not known to exist yet"""
+        if container not in swift_known_containers:
+            conn.put_container(container)
+            swift_known_containers.add(container)
+
+    @api.model
+    def _get_store_clone_copier(self, storage):
+        if storage != "swift":
+            return super()._get_store_clone_copier(storage)
+        container = os.environ.get("SWIFT_WRITE_CONTAINER")
+        self._ensure_swift_container(self._get_swift_connection(), container)
+
+        def copy(fname):
+            swifturi = SwiftUri(fname)
+            if swifturi.container() == container:
+                return fname
+            # each thread gets its own connection
+            conn = self._get_swift_connection()
+            try:
+                # server-side COPY request
+                conn.copy_object(
+                    swifturi.container(),
+                    swifturi.item(),
+                    destination="/{}/{}".format(container, swifturi.item()),
+                )
+            except ClientException as error:
+                if error.http_status in THROTTLING_STATUS_CODES:
+                    self._storage_pushback()
+                raise
+            return "swift://{}/{}".format(container, swifturi.item())
+
+        return copy
+
     @api.model
     def _store_file_read(self, fname):
         if fname.startswith("swift://"):
@@ -134,8 +292,11 @@ class IrAttachment(models.Model):
                 return ""
             try:
                 resp, read = conn.get_object(swifturi.container(), swifturi.item())
-            except ClientException:
+            except ClientException as error:
                 read = ""
+                if error.http_status in THROTTLING_STATUS_CODES:
+                    if self._storage_pushback():
+                        raise
                 _logger.exception("Error reading object from Swift object store")
             return read
         else:
@@ -145,11 +306,19 @@ class IrAttachment(models.Model):
         if self._storage() == "swift":
             container = os.environ.get("SWIFT_WRITE_CONTAINER")
             conn = self._get_swift_connection()
-            conn.put_container(container)
+            self._ensure_swift_container(conn, container)
             filename = "swift://{}/{}".format(container, key)
             try:
-                conn.put_object(container, key, bin_data)
-            except ClientException:
+                if len(bin_data) > self._swift_segment_size():
+                    self._swift_put_large_object(conn, container, key, bin_data)
+                else:
+                    conn.put_object(container, key, bin_data)
+            except ClientException as error:
+                if error.http_status == 404:
+                    # the container has been deleted, create it on next write
+                    swift_known_containers.discard(container)
+                if error.http_status in THROTTLING_STATUS_CODES:
+                    self._storage_pushback()
                 _logger.exception("Error writing to Swift object store")
                 raise exceptions.UserError(_("Error writing to Swift")) from None
         else:
@@ -157,6 +326,147 @@ class IrAttachment(models.Model):
             filename = _super._store_file_write(key, bin_data)
         return filename
 
+    @api.model
+    def _swift_segment_size(self):
+        return int(os.environ.get("SWIFT_SEGMENT_SIZE") or DEFAULT_SEGMENT_SIZE)
+
+    @api.model
+    def _swift_segments_container(self, container):
+        return "{}_segments".format(container)
+
+    @api.model
+    def _swift_put_large_object(self, conn, container, key, bin_data):
+        """Upload an object as a Static Large Object
+
+        The data is split in segments of ``SWIFT_SEGMENT_SIZE`` bytes stored
+        in the ``<container>_segments`` container, uploaded in parallel by
+        ``SWIFT_SEGMENT_CONCURRENCY`` threads. The object itself is the
+        manifest listing the segments, which Swift concatenates on reads.
+        """
+        segment_size = self._swift_segment_size()
+        segments_container = self._swift_segments_container(container)
+        self._ensure_swift_container(conn, segments_container)
+
+        def put_segment(offset):
+            data = bin_data[offset : offset + segment_size]
+            name = "{}/{:016d}".format(key, offset)
+            # each thread uses its own connection
+            etag = self._get_swift_connection().put_object(
+                segments_container, name, data
+            )
+            return {
+                "path": "/{}/{}".format(segments_container, name),
+                "etag": etag,
+                "size_bytes": len(data),
+            }
+
+        concurrency = int(os.environ.get("SWIFT_SEGMENT_CONCURRENCY") or 4)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            manifest = list(
+                executor.map(put_segment, range(0, len(bin_data), segment_size))
+            )
+        conn.put_object(
+            container,
+            key,
+            json.dumps(manifest),
+            query_string="multipart-manifest=put",
+        )
+
+    @api.model
+    def _swift_bulk_delete(self, conn, paths):
+        """Delete objects with the bulk-delete middleware
+
+        Return False when the middleware is not available on the cluster.
+        """
+        body = "\n".join(quote(path) for path in paths)
+        response = {}
+        __, content = conn.post_account(
+            headers={"Content-Type": "text/plain", "Accept": "application/json"},
+            query_string="bulk-delete",
+            data=body.encode("utf-8"),
+            response_dict=response,
+        )
+        try:
+            result = json.loads(content)
+        except (TypeError, ValueError):
+            result = None
+        if not isinstance(result, dict) or "Number Deleted" not in result:
+            # without the middleware, the request is a simple account POST
+            return False
+        for name, status in result.get("Errors") or []:
+            _logger.error("Error during deletion of the file %s: %s", name, status)
+        _logger.info(
+            "%s files deleted on the object storage (%s not found)",
+            result["Number Deleted"],
+            result.get("Number Not Found"),
+        )
+        return True
+
+    def _swift_segment_paths(self, conn, container, keys):
+        """Return the paths of the segments of the large objects ``keys``"""
+        segments_container = self._swift_segments_container(container)
+        paths = []
+        for key in keys:
+            try:
+                __, segments = conn.get_container(
+                    segments_container, prefix=key + "/", full_listing=True
+                )
+            except ClientException as error:
+                if error.http_status != 404:
+                    _logger.exception("Error listing the Swift segments of %s", key)
+                continue
+            paths += [
+                "/{}/{}".format(segments_container, segment["name"])
+                for segment in segments
+            ]
+        return paths
+
+    @api.model
+    def _store_file_delete_many(self, fnames, file_sizes=None):
+        container = os.environ.get("SWIFT_WRITE_CONTAINER")
+        keys = []
+        other_fnames = []
+        large_keys = []
+        segment_size = self._swift_segment_size()
+        for fname in fnames:
+            if fname.startswith("swift://"):
+                swifturi = SwiftUri(fname)
+                # delete the file only if it is on the current configured
+                # container otherwise, we might delete files used on a
+                # different environment
+                if swifturi.container() == container:
+                    keys.append(swifturi.item())
+                    # only the files larger than a segment have been
+                    # uploaded as large objects
+                    file_size = (file_sizes or {}).get(fname)
+                    if file_size is None or file_size > segment_size:
+                        large_keys.append(swifturi.item())
+            else:
+                other_fnames.append(fname)
+        if other_fnames:
+            super()._store_file_delete_many(other_fnames, file_sizes=file_sizes)
+        if len(keys) < 2:
+            for key in keys:
+                self._store_file_delete("swift://{}/{}".format(container, key))
+            return
+        conn = self._get_swift_connection()
+        paths = ["/{}/{}".format(container, key) for key in keys]
+        # the segments of the large objects must be deleted as well, they
+        # are named after the key of their object
+        paths += self._swift_segment_paths(conn, container, large_keys)
+        for index in range(0, len(paths), BULK_DELETE_SIZE):
+            batch = paths[index : index + BULK_DELETE_SIZE]
+            try:
+                if self._swift_bulk_delete(conn, batch):
+                    continue
+            except ClientException:
+                _logger.exception("Error during the bulk deletion on Swift")
+                continue
+            _logger.info("bulk-delete not available on Swift, deleting one by one")
+            for key in keys:
+                self._store_file_delete("swift://{}/{}".format(container, key))
+            return
+
     @api.model
     def _store_file_delete(self, fname):
         if fname.startswith("swift://"):
@@ -167,7 +477,13 @@ class IrAttachment(models.Model):
             if container == os.environ.get("SWIFT_WRITE_CONTAINER"):
                 conn = self._get_swift_connection()
                 try:
-                    conn.delete_object(container, swifturi.item())
+                    # deletes the segments as well for large objects, the
+                    # parameter is ignored for the other objects
+                    conn.delete_object(
+                        container,
+                        swifturi.item(),
+                        query_string="multipart-manifest=delete",
+                    )
                 except ClientException:
                     _logger.exception(_("Error deleting an object on the Swift store"))
                     # we ignore the error, file will stay on the object
@@ -1 +1,2 @@
 from . import test_mock_swift_api
+from . import test_swift_bulk_operations
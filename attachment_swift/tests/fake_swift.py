@@ -0,0 +1,115 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import hashlib
+import json
+from urllib.parse import unquote
+
+from swiftclient.exceptions import ClientException
+
+
+class FakeSwiftConnection(object):
+    """In-memory replacement of ``swiftclient.client.Connection``
+
+    Implements the subset of the Swift API used by attachment_swift,
+    including the Static Large Objects manifests and the bulk-delete
+    middleware. The objects are shared by all the connections.
+    """
+
+    containers = set()
+    objects = {}
+    manifests = {}
+    bulk_delete_requests = 0
+    listings = []
+
+    def __init__(self, session=None, os_options=None, **kwargs):
+        self.session = session
+        self.os_options = os_options
+
+    @classmethod
+    def reset(cls):
+        cls.containers.clear()
+        cls.objects.clear()
+        cls.manifests.clear()
+        cls.bulk_delete_requests = 0
+        cls.listings.clear()
+
+    def put_container(self, container, **kwargs):
+        self.containers.add(container)
+
+    def get_container(self, container, full_listing=False, prefix=None, **kwargs):
+        self.listings.append((container, prefix))
+        if container not in self.containers:
+            raise ClientException("Container GET failed", http_status=404)
+        names = sorted(
+            name
+            for (obj_container, name) in list(self.objects) + list(self.manifests)
+            if obj_container == container and name.startswith(prefix or "")
+        )
+        return {}, [{"name": name} for name in names]
+
+    def put_object(self, container, obj, contents, query_string=None, **kwargs):
+        if container not in self.containers:
+            raise ClientException("Object PUT failed", http_status=404)
+        if isinstance(contents, str):
+            contents = contents.encode("utf-8")
+        if query_string == "multipart-manifest=put":
+            manifest = json.loads(contents)
+            for segment in manifest:
+                segment_container, name = segment["path"].lstrip("/").split("/", 1)
+                data = self.objects.get((segment_container, name))
+                if data is None or hashlib.md5(data).hexdigest() != segment["etag"]:
+                    raise ClientException("Invalid SLO manifest", http_status=400)
+            self.manifests[(container, obj)] = manifest
+            self.objects.pop((container, obj), None)
+        else:
+            self.objects[(container, obj)] = contents
+            self.manifests.pop((container, obj), None)
+        return hashlib.md5(contents).hexdigest()
+
+    def get_object(self, container, obj, **kwargs):
+        manifest = self.manifests.get((container, obj))
+        if manifest is not None:
+            return {}, b"".join(
+                self.objects[tuple(segment["path"].lstrip("/").split("/", 1))]
+                for segment in manifest
+            )
+        if (container, obj) not in self.objects:
+            raise ClientException("Object GET failed", http_status=404)
+        return {}, self.objects[(container, obj)]
+
+    def _delete(self, container, obj, delete_segments=False):
+        manifest = self.manifests.pop((container, obj), None)
+        if manifest is not None:
+            if delete_segments:
+                for segment in manifest:
+                    path = tuple(segment["path"].lstrip("/").split("/", 1))
+                    self.objects.pop(path, None)
+            return True
+        return self.objects.pop((container, obj), None) is not None
+
+    def delete_object(self, container, obj, query_string=None, **kwargs):
+        delete_segments = query_string == "multipart-manifest=delete"
+        if not self._delete(container, obj, delete_segments=delete_segments):
+            raise ClientException("Object DELETE failed", http_status=404)
+
+    def post_account(
+        self, headers, response_dict=None, query_string=None, data=None, **kwargs
+    ):
+        if query_string != "bulk-delete":
+            return {}, b""
+        self.__class__.bulk_delete_requests += 1
+        deleted = not_found = 0
+        for line in data.decode("utf-8").splitlines():
+            container, obj = unquote(line).lstrip("/").split("/", 1)
+            if self._delete(container, obj):
+                deleted += 1
+            else:
+                not_found += 1
+        result = {
+            "Number Deleted": deleted,
+            "Number Not Found": not_found,
+            "Errors": [],
+            "Response Status": "200 OK",
+        }
+        return {}, json.dumps(result).encode("utf-8")
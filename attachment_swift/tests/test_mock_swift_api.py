@@ -8,7 +8,11 @@ import keystoneauth1
 import mock
 from mock import patch
 
-from odoo.addons.attachment_swift.models.ir_attachment import SwiftSessionStore
+from odoo.addons.attachment_swift.models.ir_attachment import (
+    SwiftSessionStore,
+    swift_connection_store,
+    swift_known_containers,
+)
 from odoo.addons.attachment_swift.swift_uri import SwiftUri
 from odoo.addons.base.tests.test_ir_attachment import TestIrAttachment
 
@@ -19,6 +23,13 @@ class TestAttachmentSwift(TestIrAttachment):
         self.env["ir.config_parameter"].set_param("ir_attachment.location", "swift")
         return res
 
+    def setUp(self):
+        super().setUp()
+        # connections are kept per thread, the mocked ones must not leak
+        # between tests
+        swift_connection_store.clear()
+        swift_known_containers.clear()
+
     def test_session_store_get_session(self):
         auth_url = "auth_url"
         username = "username"
@@ -51,6 +62,28 @@ class TestAttachmentSwift(TestIrAttachment):
             session,
         )
 
+    def test_session_store_refresh_tokens(self):
+        store = SwiftSessionStore()
+        expiring_auth_ref = mock.Mock()
+        expiring_auth_ref.will_expire_soon.return_value = True
+        new_auth_ref = mock.Mock()
+        with patch.object(
+            keystoneauth1.identity.v3.Password,
+            "get_auth_ref",
+            return_value=new_auth_ref,
+        ):
+            session = store.get_session(
+                auth_url="auth_url",
+                username="username",
+                password="password",
+                project_name="project_name",
+            )
+            session.auth.auth_ref = expiring_auth_ref
+            store.refresh_tokens()
+        expiring_auth_ref.will_expire_soon.assert_called_once_with(store.refresh_margin)
+        self.assertEqual(session.auth.auth_ref, new_auth_ref)
+        self.assertEqual(store.auth_calls, 1)
+
     @patch("swiftclient.client")
     def test_connection(self, mock_swift_client):
         """Test the connection to the store"""
@@ -99,6 +132,23 @@ class TestAttachmentSwift(TestIrAttachment):
                 container, attachment._compute_checksum(bin_data), bin_data
             )
 
+    def test_store_files_reuse_connection(self):
+        """The connection and the container are reused by the writes"""
+        (self.env["ir.config_parameter"].set_param("ir_attachment.location", "swift"))
+        os.environ["SWIFT_AUTH_URL"] = "auth_url"
+        os.environ["SWIFT_ACCOUNT"] = "account"
+        os.environ["SWIFT_PASSWORD"] = "password"
+        os.environ["SWIFT_PROJECT_NAME"] = "project_name"
+        os.environ["SWIFT_WRITE_CONTAINER"] = "my_container"
+        attachment = self.Attachment
+        with patch("swiftclient.client.Connection") as MockConnection:
+            conn = MockConnection.return_value
+            attachment.create({"name": "a5", "datas": self.blob1_b64})
+            attachment.create({"name": "a6", "datas": self.blob2_b64})
+            MockConnection.assert_called_once()
+            conn.put_container.assert_called_once_with("my_container")
+            self.assertEqual(conn.put_object.call_count, 2)
+
     def test_delete_file_on_swift(self):
         """
         Test deleting a file
@@ -117,4 +167,6 @@ class TestAttachmentSwift(TestIrAttachment):
             a5 = attachment.create({"name": "a5", "datas": self.blob1_b64})
             uri = SwiftUri(a5.store_fname)
             a5.unlink()
-            conn.delete_object.assert_called_with(container, uri.item())
+            conn.delete_object.assert_called_with(
+                container, uri.item(), query_string="multipart-manifest=delete"
+            )
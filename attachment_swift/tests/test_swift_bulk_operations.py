@@ -0,0 +1,88 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import os
+
+from mock import patch
+
+from odoo.tests.common import TransactionCase
+
+from odoo.addons.attachment_swift.models.ir_attachment import (
+    swift_connection_store,
+    swift_known_containers,
+)
+from odoo.addons.attachment_swift.swift_uri import SwiftUri
+
+from .fake_swift import FakeSwiftConnection
+
+
+class TestSwiftBulkOperations(TransactionCase):
+    """Large objects and bulk deletion against a fake Swift endpoint"""
+
+    def setUp(self):
+        super().setUp()
+        self.env["ir.config_parameter"].set_param("ir_attachment.location", "swift")
+        env_patcher = patch.dict(
+            os.environ,
+            {
+                "SWIFT_AUTH_URL": "auth_url",
+                "SWIFT_ACCOUNT": "account",
+                "SWIFT_PASSWORD": "password",
+                "SWIFT_PROJECT_NAME": "project_name",
+                "SWIFT_WRITE_CONTAINER": "my_container",
+                "SWIFT_SEGMENT_SIZE": "4",
+            },
+        )
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        connection_patcher = patch("swiftclient.client.Connection", FakeSwiftConnection)
+        connection_patcher.start()
+        self.addCleanup(connection_patcher.stop)
+        FakeSwiftConnection.reset()
+        swift_connection_store.clear()
+        swift_known_containers.clear()
+        self.Attachment = self.env["ir.attachment"]
+
+    def test_store_large_file(self):
+        data = b"0123456789"
+        attachment = self.Attachment.create({"name": "large", "raw": data})
+        uri = SwiftUri(attachment.store_fname)
+        manifest = FakeSwiftConnection.manifests[(uri.container(), uri.item())]
+        self.assertEqual([segment["size_bytes"] for segment in manifest], [4, 4, 2])
+        attachment.invalidate_recordset()
+        self.assertEqual(attachment.raw, data)
+
+    def test_store_small_file(self):
+        attachment = self.Attachment.create({"name": "small", "raw": b"0123"})
+        uri = SwiftUri(attachment.store_fname)
+        self.assertEqual(
+            FakeSwiftConnection.objects[(uri.container(), uri.item())], b"0123"
+        )
+        self.assertFalse(FakeSwiftConnection.manifests)
+
+    def test_delete_large_file(self):
+        attachment = self.Attachment.create({"name": "large", "raw": b"0123456789"})
+        attachment.unlink()
+        self.assertFalse(FakeSwiftConnection.manifests)
+        self.assertFalse(FakeSwiftConnection.objects)
+
+    def test_bulk_delete(self):
+        attachments = self.Attachment.create(
+            [
+                {"name": "a1", "raw": b"abc"},
+                {"name": "a2", "raw": b"def"},
+                {"name": "a3", "raw": b"0123456789"},
+            ]
+        )
+        self.assertEqual(len(FakeSwiftConnection.objects), 5)
+        large_key = SwiftUri(attachments[2].store_fname).item()
+        FakeSwiftConnection.listings.clear()
+        attachments.unlink()
+        self.assertEqual(FakeSwiftConnection.bulk_delete_requests, 1)
+        # only the segments of the large object are listed
+        self.assertEqual(
+            FakeSwiftConnection.listings,
+            [("my_container_segments", large_key + "/")],
+        )
+        self.assertFalse(FakeSwiftConnection.manifests)
+        self.assertFalse(FakeSwiftConnection.objects)
@@ -1,10 +1,12 @@
 # Copyright 2017-2019 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import functools
 import inspect
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import closing, contextmanager
 
 import psycopg2
@@ -14,10 +16,17 @@ from odoo import _, api, exceptions, models
 from odoo.osv.expression import AND, OR, normalize_domain
 from odoo.tools.safe_eval import const_eval
 
+from ..throttle import StorageThrottle
 from .strtobool import strtobool
 
 _logger = logging.getLogger(__name__)
 
+# number of attachments claimed and committed at once when migrating to the
+# object storage
+MIGRATION_BATCH_SIZE = 100
+# number of files copied and committed at once when cloning a storage
+CLONE_BATCH_SIZE = 1000
+
 
 def is_true(strval):
     return bool(strtobool(strval or "0"))
@@ -109,6 +118,61 @@ class IrAttachment(models.Model):
             storage_config = self._object_storage_default_force_db_config
         return storage_config
 
+    @api.model
+    def _get_storage_throttle_rate(self, key, env_var):
+        value = self.env["ir.config_parameter"].sudo().get_param(key)
+        value = value or os.environ.get(env_var)
+        try:
+            return float(value or 0)
+        except ValueError:
+            _logger.error(
+                "Could not parse the storage rate limit '%s', no limit applied.",
+                value,
+            )
+            return 0
+
+    @api.model
+    def _get_storage_throttle(self):
+        """Return the throttle used by the bulk operations on the storage
+
+        Migrations to and from the object storage read or write every
+        attachment at full speed, which competes with the live traffic and
+        triggers rate limiting on the object storage. The limits are read in
+        the system parameters:
+
+        * ``ir_attachment.storage.throttle.bytes_per_second``
+        * ``ir_attachment.storage.throttle.requests_per_second``
+
+        Or when not set, in the environment variables
+        ``ATTACHMENT_STORAGE_THROTTLE_BYTES_PER_SECOND`` and
+        ``ATTACHMENT_STORAGE_THROTTLE_REQUESTS_PER_SECOND``. 0 means no limit.
+        """
+        return StorageThrottle(
+            bytes_per_second=self._get_storage_throttle_rate(
+                "ir_attachment.storage.throttle.bytes_per_second",
+                "ATTACHMENT_STORAGE_THROTTLE_BYTES_PER_SECOND",
+            ),
+            requests_per_second=self._get_storage_throttle_rate(
+                "ir_attachment.storage.throttle.requests_per_second",
+                "ATTACHMENT_STORAGE_THROTTLE_REQUESTS_PER_SECOND",
+            ),
+        )
+
+    @api.model
+    def _storage_pushback(self):
+        """Slow down the current bulk operation
+
+        To be called by the stores when the backend rejects a request
+        because of its rate limiting (HTTP 429, 503 SlowDown, ...). Return
+        True during a bulk operation: the store must then raise the error
+        so the operation is retried, instead of returning an empty content.
+        """
+        throttle = self.env.context.get("storage_throttle")
+        if throttle is None:
+            return False
+        throttle.pushback()
+        return True
+
     def _store_in_db_instead_of_object_storage_domain(self):
         """Return a domain for attachments that must be forced to DB
 
@@ -217,6 +281,39 @@ class IrAttachment(models.Model):
         storage = fname.partition("://")[0]
         raise NotImplementedError("No implementation for %s" % (storage,))
 
+    def _store_file_delete_many(self, fnames, file_sizes=None):
+        """Delete several files from their store
+
+        The stores supporting batch deletion override this method to delete
+        the files with as few requests as possible. The files must already be
+        known as unused by any attachment. ``file_sizes`` maps the files to
+        their size when it is known.
+        """
+        for fname in fnames:
+            self._store_file_delete(fname)
+
+    def _store_list_files(self, storage, prefix=""):
+        """Iterate over the files of the current bucket / container
+
+        Yield the ``store_fname`` of the files whose key starts with
+        ``prefix``. Used by maintenance operations (cleanup of unused files,
+        ...), the stores list the files page by page.
+        """
+        raise NotImplementedError("No implementation for %s" % (storage,))
+
+    def _get_store_clone_copier(self, storage):
+        """Return a function copying a file on the current store
+
+        The function receives the ``store_fname`` of a file located in
+        another bucket / container of the same store, copies it with a
+        server-side copy in the current bucket / container and returns the
+        new ``store_fname``. When the file is already in the current
+        bucket / container, its ``store_fname`` is returned unchanged.
+
+        The function is called in threads, it must not use the environment.
+        """
+        raise NotImplementedError("No implementation for %s" % (storage,))
+
     @api.model
     def _file_write(self, bin_data, checksum):
         location = self.env.context.get("storage_location") or self._storage()
@@ -229,9 +326,41 @@ class IrAttachment(models.Model):
             filename = super()._file_write(bin_data, checksum)
         return filename
 
+    def unlink(self):
+        # the files of the stores are deleted together after the unlink,
+        # instead of one request per file
+        file_sizes = {
+            attachment.store_fname: attachment.file_size
+            for attachment in self
+            if attachment.store_fname
+            and self._is_file_from_a_store(attachment.store_fname)
+        }
+        res = super(IrAttachment, self.with_context(store_delete_many=True)).unlink()
+        if file_sizes:
+            self._file_delete_many(list(file_sizes), file_sizes=file_sizes)
+        return res
+
+    @api.model
+    def _file_delete_many(self, fnames, file_sizes=None):
+        """Delete the files of the stores no longer used by any attachment"""
+        cr = self.env.cr
+        # using SQL to include files hidden through unlink or due to record
+        # rules
+        cr.execute(
+            "SELECT DISTINCT store_fname FROM ir_attachment WHERE store_fname IN %s",
+            (tuple(fnames),),
+        )
+        used = {row[0] for row in cr.fetchall()}
+        unused = [fname for fname in fnames if fname not in used]
+        if unused:
+            self._store_file_delete_many(unused, file_sizes=file_sizes)
+
     @api.model
     def _file_delete(self, fname):
         if self._is_file_from_a_store(fname):
+            if self.env.context.get("store_delete_many"):
+                # deleted by batch by unlink()
+                return
             cr = self.env.cr
             # using SQL to include files hidden through unlink or due to record
             # rules
@@ -353,7 +482,10 @@ class IrAttachment(models.Model):
         )
 
         with self.do_in_new_env(new_cr=new_cr) as new_env:
-            model_env = new_env["ir.attachment"].with_context(prefetch_fields=False)
+            throttle = new_env["ir.attachment"]._get_storage_throttle()
+            model_env = new_env["ir.attachment"].with_context(
+                prefetch_fields=False, storage_throttle=throttle
+            )
             attachment_ids = model_env.search(domain).ids
             if not attachment_ids:
                 return
@@ -373,7 +505,18 @@ class IrAttachment(models.Model):
                 # this write will read the datas from the Object Storage and
                 # write them back in the DB (the logic for location to write is
                 # in the 'datas' inverse computed field)
-                attachment.write({"datas": attachment.datas})
+                try:
+                    with new_env.cr.savepoint():
+                        throttle.call(
+                            lambda att=attachment: att._move_file_to_db(),
+                            nbytes=attachment.file_size,
+                        )
+                except Exception:
+                    # still throttled after the retries, the file stays in
+                    # the object storage and the migration goes on
+                    _logger.exception(
+                        "Could not move attachment %s to the DB", attachment_id
+                    )
                 # as the file will potentially be dropped on the bucket,
                 # we should commit the changes here
                 new_env.cr.commit()
@@ -385,8 +528,40 @@ class IrAttachment(models.Model):
                         time.time() - start_time,
                     )
 
+    def _move_file_to_db(self):
+        """Read the file of the attachment in its store and write it in the DB
+
+        A file which cannot be read is left in its store: writing the empty
+        content would delete the file.
+        """
+        self.ensure_one()
+        # a failed read must not be served from the cache on retry
+        self.invalidate_recordset(["raw", "datas"])
+        datas = self.datas
+        if not datas and self.file_size:
+            _logger.warning(
+                "attachment %s (%s) could not be read, left in the object storage",
+                self.id,
+                self.store_fname,
+            )
+            return
+        self.write({"datas": datas})
+
     @api.model
-    def _force_storage_to_object_storage(self, new_cr=False):
+    def _force_storage_to_object_storage(self, new_cr=False, batch_size=None):
+        """Move the attachments from the filesystem or database to the store
+
+        The attachments are claimed by batches of ``batch_size`` rows. Several
+        workers or pods can run this method at the same time on the same
+        database: each batch is locked with ``FOR UPDATE SKIP LOCKED`` so the
+        processes never work on the same attachments.
+
+        The batches are committed one after the other when the method works
+        in a dedicated cursor (``new_cr``). Otherwise the transaction of the
+        caller, for instance the loading of the modules, is only committed
+        when files have been moved from the filesystem, before they are
+        deleted.
+        """
         _logger.info("migrating files to the object storage")
         storage = self.env.context.get("storage_location") or self._storage()
         if self.is_storage_disabled(storage):
@@ -409,44 +584,157 @@ class IrAttachment(models.Model):
         # serialization issues due to concurrent updates on attachments during
         # the installation
         with self.do_in_new_env(new_cr=new_cr) as new_env:
-            model_env = new_env["ir.attachment"]
-            ids = model_env.search(domain).ids
-            files_to_clean = []
-            for attachment_id in ids:
-                try:
-                    with new_env.cr.savepoint():
-                        # check that no other transaction has
-                        # locked the row, don't send a file to storage
-                        # in that case
-                        self.env.cr.execute(
-                            "SELECT id "
-                            "FROM ir_attachment "
-                            "WHERE id = %s "
-                            "FOR UPDATE NOWAIT",
-                            (attachment_id,),
-                            log_exceptions=False,
-                        )
+            throttle = new_env["ir.attachment"]._get_storage_throttle()
+            model_env = new_env["ir.attachment"].with_context(storage_throttle=throttle)
+            batch_size = batch_size or MIGRATION_BATCH_SIZE
+            last_id = 0
+            while True:
+                ids = model_env._claim_attachments_to_migrate(
+                    domain, last_id, batch_size
+                )
+                if not ids:
+                    break
+                last_id = ids[-1]
+                files_to_clean = []
+                for attachment_id in ids:
+
+                    def move(attachment_id=attachment_id):
+                        with new_env.cr.savepoint():
+                            # This is a trick to avoid having the 'datas'
+                            # function fields computed for every attachment on
+                            # each iteration of the loop. The former issue
+                            # being that it reads the content of the file of
+                            # ALL the attachments on each loop.
+                            new_env.clear()
+                            attachment = model_env.browse(attachment_id)
+                            return attachment._move_attachment_to_store()
 
-                        # This is a trick to avoid having the 'datas'
-                        # function fields computed for every attachment on
-                        # each iteration of the loop. The former issue
-                        # being that it reads the content of the file of
-                        # ALL the attachments on each loop.
-                        new_env.clear()
-                        attachment = model_env.browse(attachment_id)
-                        path = attachment._move_attachment_to_store()
+                    try:
+                        path = throttle.call(
+                            move, nbytes=model_env.browse(attachment_id).file_size
+                        )
                         if path:
                             files_to_clean.append(path)
-                except psycopg2.OperationalError:
-                    _logger.error(
-                        "Could not migrate attachment %s to S3", attachment_id
-                    )
+                    except psycopg2.OperationalError:
+                        _logger.error(
+                            "Could not migrate attachment %s to the object storage",
+                            attachment_id,
+                        )
 
-            # delete the files from the filesystem once we know the changes
-            # have been committed in ir.attachment
-            if files_to_clean:
-                new_env.cr.commit()
-                clean_fs(files_to_clean)
+                # committing releases the rows claimed by this batch, and the
+                # files are deleted from the filesystem only once we know the
+                # changes have been committed in ir.attachment
+                if new_cr or files_to_clean:
+                    new_env.cr.commit()
+                if files_to_clean:
+                    clean_fs(files_to_clean)
+                _logger.info(
+                    "migrated a batch of %d attachments up to id %d",
+                    len(ids),
+                    last_id,
+                )
+
+    @api.model
+    def _claim_attachments_to_migrate(self, domain, last_id, limit):
+        """Lock and return the ids of the next batch of attachments to migrate
+
+        The rows are locked with ``FOR UPDATE SKIP LOCKED``: rows already
+        locked by another transaction, for instance another worker or pod
+        running the same migration, are skipped instead of waited for. This
+        allows several processes to migrate the same database concurrently,
+        each one working on its own batches.
+
+        The ids are claimed in ascending order starting after ``last_id``, so
+        attachments which could not be moved are not claimed again.
+        """
+        self.flush_model()
+        query = self._where_calc(AND([domain, [("id", ">", last_id)]]))
+        query.order = '"ir_attachment"."id"'
+        query.limit = limit
+        query_str, params = query.select()
+        self.env.cr.execute(query_str + " FOR UPDATE SKIP LOCKED", params)
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.model
+    def clone_object_storage(self, max_workers=8, new_cr=False, batch_size=None):
+        """Copy the files of another bucket or container in the current one
+
+        When a production database is cloned to an integration or labs
+        instance, its attachments still point to the production bucket
+        which must be used read-only. This method copies the files in the
+        bucket / container of the current instance with server-side copies,
+        so no payload goes through Odoo.
+
+        The files are processed by batches of ``batch_size``: the copies of
+        a batch run in ``max_workers`` parallel threads, then the
+        ``store_fname`` of its attachments are rewritten and committed. An
+        interrupted clone can be run again, the files already in the current
+        bucket / container are not copied again.
+
+        It is not called anywhere, but can be called by RPC or scripts.
+        """
+        if not self.env["res.users"].browse(self.env.uid)._is_admin():
+            raise exceptions.AccessError(
+                _("Only administrators can execute this action.")
+            )
+        storage = self.env.context.get("storage_location") or self._storage()
+        if storage not in self._get_stores():
+            return
+        if self.is_storage_disabled(storage):
+            return
+        batch_size = batch_size or CLONE_BATCH_SIZE
+        with self.do_in_new_env(new_cr=new_cr) as new_env:
+            throttle = new_env["ir.attachment"]._get_storage_throttle()
+            model_env = new_env["ir.attachment"].with_context(storage_throttle=throttle)
+            copy = model_env._get_store_clone_copier(storage)
+            new_env.cr.execute(
+                "SELECT DISTINCT store_fname FROM ir_attachment "
+                "WHERE store_fname LIKE %s",
+                ("{}://%".format(storage),),
+            )
+            fnames = [row[0] for row in new_env.cr.fetchall()]
+            total = len(fnames)
+            start_time = time.time()
+            cloned = 0
+            _logger.info("Cloning %d files on the %s storage", total, storage)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for offset in range(0, total, batch_size):
+                    batch = fnames[offset : offset + batch_size]
+                    futures = {
+                        executor.submit(
+                            throttle.call, functools.partial(copy, fname)
+                        ): fname
+                        for fname in batch
+                    }
+                    renamed = []
+                    for future in as_completed(futures):
+                        fname = futures[future]
+                        try:
+                            new_fname = future.result()
+                        except Exception:
+                            _logger.exception("Could not clone the file %s", fname)
+                            continue
+                        if new_fname != fname:
+                            renamed.append((fname, new_fname))
+                    if renamed:
+                        old_fnames, new_fnames = zip(*renamed)
+                        new_env.cr.execute(
+                            "UPDATE ir_attachment SET store_fname = v.new_fname "
+                            "FROM unnest(%s, %s) AS v(fname, new_fname) "
+                            "WHERE ir_attachment.store_fname = v.fname",
+                            (list(old_fnames), list(new_fnames)),
+                        )
+                    # the progress is kept if the clone is interrupted
+                    new_env.cr.commit()
+                    cloned += len(renamed)
+                    _logger.info(
+                        "file %s/%s after %.2fs",
+                        min(offset + batch_size, total),
+                        total,
+                        time.time() - start_time,
+                    )
+            model_env.invalidate_model(["store_fname"])
+            _logger.info("%d files cloned on the %s storage", cloned, storage)
 
     def _get_stores(self):
         """To get the list of stores activated in the system"""
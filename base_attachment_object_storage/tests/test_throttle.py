@@ -0,0 +1,149 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+from unittest.mock import patch
+
+from odoo.tests.common import BaseCase
+
+from odoo.addons.base_attachment_object_storage import throttle
+from odoo.addons.base_attachment_object_storage.throttle import (
+    StorageThrottle,
+    TokenBucket,
+)
+
+
+class FakeClock(object):
+    """Replace the time module of the throttle, sleeping advances the clock"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class ThrottledError(Exception):
+    pass
+
+
+class TestThrottle(BaseCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        patcher = patch.object(throttle, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bucket_no_limit(self):
+        bucket = TokenBucket(0)
+        for __ in range(100):
+            self.assertEqual(bucket.consume(1000), 0.0)
+        self.assertFalse(self.clock.sleeps)
+
+    def test_bucket_refill(self):
+        bucket = TokenBucket(10)
+        # starts full, one second worth of tokens
+        self.assertEqual(bucket.consume(10), 0.0)
+        self.assertEqual(bucket.consume(5), 0.5)
+        self.assertEqual(self.clock.sleeps, [0.5])
+        # the tokens consumed in debt are refilled by the sleep
+        self.clock.advance(1)
+        self.assertEqual(bucket.consume(10), 0.0)
+        # never refilled above the capacity
+        self.clock.advance(60)
+        self.assertEqual(bucket.consume(10), 0.0)
+        self.assertEqual(bucket.consume(10), 1.0)
+
+    def test_bucket_debt(self):
+        bucket = TokenBucket(10)
+        # an amount larger than the capacity waits for the missing tokens
+        self.assertEqual(bucket.consume(30), 2.0)
+        self.assertEqual(bucket.consume(10), 1.0)
+
+    def test_pushback_backoff(self):
+        storage_throttle = StorageThrottle(
+            bytes_per_second=1000, requests_per_second=100
+        )
+        backoffs = []
+        for __ in range(8):
+            storage_throttle.pushback()
+            backoffs.append(storage_throttle._backoff)
+        self.assertEqual(backoffs, [1, 2, 4, 8, 16, 32, 60, 60])
+        self.assertEqual(storage_throttle.pushbacks, 8)
+        # the rates are halved down to the minimum factor
+        self.assertEqual(storage_throttle.factor, StorageThrottle.min_factor)
+        self.assertEqual(storage_throttle._bytes.rate, 1000 * 0.05)
+        self.assertEqual(storage_throttle._requests.rate, 100 * 0.05)
+        self.clock.sleeps.clear()
+        storage_throttle.wait()
+        self.assertEqual(self.clock.sleeps[0], 60)
+
+    def test_success_reset(self):
+        storage_throttle = StorageThrottle(requests_per_second=100)
+        storage_throttle.pushback()
+        storage_throttle.pushback()
+        self.assertEqual(storage_throttle.factor, 0.25)
+        storage_throttle.success()
+        self.assertEqual(storage_throttle._backoff, 0)
+        self.assertAlmostEqual(storage_throttle.factor, 0.26)
+        self.assertAlmostEqual(storage_throttle._requests.rate, 26)
+        # no backoff once an operation succeeded
+        self.clock.sleeps.clear()
+        storage_throttle.wait()
+        self.assertFalse(self.clock.sleeps)
+        # back to the configured rates, never above
+        for __ in range(100):
+            storage_throttle.success()
+        self.assertEqual(storage_throttle.factor, 1.0)
+        self.assertEqual(storage_throttle._requests.rate, 100)
+
+    def test_call_retry_limit(self):
+        storage_throttle = StorageThrottle(max_retries=2)
+        calls = []
+
+        def throttled():
+            calls.append(1)
+            storage_throttle.pushback()
+            raise ThrottledError()
+
+        with self.assertRaises(ThrottledError):
+            storage_throttle.call(throttled)
+        self.assertEqual(len(calls), 3)
+        # the retries were delayed by the backoff
+        self.assertEqual(self.clock.sleeps, [1, 2])
+
+    def test_call_retry_success(self):
+        storage_throttle = StorageThrottle()
+        calls = []
+
+        def throttled_once():
+            calls.append(1)
+            if len(calls) == 1:
+                storage_throttle.pushback()
+                raise ThrottledError()
+            return "done"
+
+        self.assertEqual(storage_throttle.call(throttled_once), "done")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(storage_throttle._backoff, 0)
+
+    def test_call_other_error(self):
+        storage_throttle = StorageThrottle()
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise ValueError()
+
+        # errors which are not caused by a pushback are not retried
+        with self.assertRaises(ValueError):
+            storage_throttle.call(failing)
+        self.assertEqual(len(calls), 1)
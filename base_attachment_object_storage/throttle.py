@@ -0,0 +1,125 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Limit the rate of an operation with a token bucket
+
+    Tokens are added at ``rate`` tokens per second, up to ``capacity``
+    (one second worth of tokens by default). ``consume`` blocks until the
+    requested amount is available. A rate of 0 means no limit.
+
+    An amount larger than the capacity (e.g. a large file) is accepted and
+    puts the bucket in debt: the following calls wait longer, so the
+    average rate is respected.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount=1):
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class StorageThrottle(object):
+    """Limit the bytes and requests per second of bulk storage operations
+
+    The stores report when the backend pushes back (HTTP 429, 503 SlowDown,
+    ...) with ``pushback``. The rates are then halved and the next operation
+    is delayed by an exponential backoff. Each successful operation
+    increases the rates again by a small step, up to the configured ones.
+    Without configured rates, only the backoff applies.
+    """
+
+    min_factor = 0.05
+    recovery_step = 0.01
+    max_backoff = 60
+
+    def __init__(self, bytes_per_second=0, requests_per_second=0, max_retries=5):
+        self.bytes_per_second = bytes_per_second
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.factor = 1.0
+        self.pushbacks = 0
+        self._backoff = 0
+        self._bytes = TokenBucket(bytes_per_second)
+        self._requests = TokenBucket(requests_per_second)
+        # the throttle is shared by the threads of the parallel operations
+        self._lock = threading.Lock()
+
+    def _set_factor(self, factor):
+        self.factor = factor
+        self._bytes.rate = self.bytes_per_second * factor
+        self._requests.rate = self.requests_per_second * factor
+
+    def wait(self, nbytes=0):
+        """Block until one request of ``nbytes`` bytes is allowed"""
+        backoff = self._backoff
+        if backoff:
+            time.sleep(backoff)
+        self._requests.consume(1)
+        if nbytes:
+            self._bytes.consume(nbytes)
+
+    def pushback(self):
+        """Slow down after the backend rejected a request"""
+        with self._lock:
+            self.pushbacks += 1
+            self._backoff = min(self.max_backoff, (self._backoff * 2) or 1)
+            self._set_factor(max(self.min_factor, self.factor / 2))
+            factor, backoff = self.factor, self._backoff
+        _logger.warning(
+            "object storage is throttling requests, slowing down to %d%% "
+            "of the configured rates with a backoff of %ss",
+            factor * 100,
+            backoff,
+        )
+
+    def success(self):
+        with self._lock:
+            self._backoff = 0
+            if self.factor < 1:
+                self._set_factor(min(1.0, self.factor + self.recovery_step))
+
+    def call(self, func, nbytes=0):
+        """Call ``func`` within the limits
+
+        When ``func`` fails after the backend pushed back, it is retried up to
+        ``max_retries`` times. Other errors are raised immediately.
+        """
+        attempt = 0
+        while True:
+            self.wait(nbytes)
+            pushbacks = self.pushbacks
+            try:
+                result = func()
+            except Exception:
+                if self.pushbacks == pushbacks or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                _logger.info("retrying throttled storage operation (%d)", attempt)
+                continue
+            self.success()
+            return result
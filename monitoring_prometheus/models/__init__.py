@@ -1,2 +1,3 @@
 from . import ir_http
 from . import psutils_helpers
+from . import session_store_metrics
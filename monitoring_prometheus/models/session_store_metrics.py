@@ -0,0 +1,45 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+
+from prometheus_client import Counter, Histogram
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from odoo.addons.session_redis.metrics import session_metrics
+except ImportError:
+    session_metrics = None  # noqa
+    _logger.debug("Cannot 'import odoo.addons.session_redis.metrics'.")
+
+SESSION_STORE_EVENTS = Counter(
+    "session_store_events", "Session store events (hits, misses, ...)", ["event"]
+)
+SESSION_STORE_LATENCY = Histogram(
+    "session_store_latency_sec",
+    "Session store operation time in sec",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+SESSION_STORE_PAYLOAD = Histogram(
+    "session_store_payload_bytes",
+    "Size of the sessions read and written in bytes",
+    ["operation"],
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576),
+)
+
+
+class PrometheusSessionStoreReporter(object):
+    def event(self, name):
+        SESSION_STORE_EVENTS.labels(name).inc()
+
+    def latency(self, operation, seconds):
+        SESSION_STORE_LATENCY.labels(operation).observe(seconds)
+
+    def payload(self, operation, nbytes):
+        SESSION_STORE_PAYLOAD.labels(operation).observe(nbytes)
+
+
+if session_metrics is not None:
+    session_metrics.add_reporter(PrometheusSessionStoreReporter())
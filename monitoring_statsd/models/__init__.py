@@ -1 +1,2 @@
 from . import ir_http
+from . import session_store_metrics
@@ -0,0 +1,32 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+
+from ..statsd_client import customer, environment, statsd
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from odoo.addons.session_redis.metrics import session_metrics
+except ImportError:
+    session_metrics = None  # noqa
+    _logger.debug("Cannot 'import odoo.addons.session_redis.metrics'.")
+
+
+class StatsdSessionStoreReporter(object):
+    def _name(self, *parts):
+        return ".".join(("session", customer, environment) + parts)
+
+    def event(self, name):
+        statsd.incr(self._name(name))
+
+    def latency(self, operation, seconds):
+        statsd.timing(self._name("latency", operation), seconds * 1000)
+
+    def payload(self, operation, nbytes):
+        statsd.timing(self._name("payload", operation), nbytes)
+
+
+if statsd and session_metrics is not None:
+    session_metrics.add_reporter(StatsdSessionStoreReporter())
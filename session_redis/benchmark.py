@@ -0,0 +1,227 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+"""Benchmark of the Redis session store
+
+Measure the throughput and latency of ``get``, ``save``, ``rotate`` and
+``list`` with realistic sessions, against a Redis server or fakeredis::
+
+    python -m odoo.addons.session_redis.benchmark --url redis://localhost/15
+    python -m odoo.addons.session_redis.benchmark --fake --codec msgpack \\
+        --compression zlib --concurrency 1,8,32
+
+Use a dedicated database: the sessions are written with the ``benchmark``
+prefix and deleted at the end.
+"""
+
+import argparse
+import secrets
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+from odoo import http
+
+from .codec import SessionCodec
+from .metrics import SessionStoreMetrics
+from .session import RedisSessionStore
+
+try:
+    import redis
+except ImportError:
+    redis = None  # noqa
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None  # noqa
+
+OPERATIONS = ("get", "save", "save_unchanged", "rotate", "list")
+
+
+def session_payload(uid, size=0):
+    """Content of a session of a logged user, as stored by Odoo"""
+    now = datetime.now()
+    data = {
+        "db": "odoo",
+        "debug": "",
+        "login": "user%s@example.com" % uid,
+        "uid": uid,
+        "session_token": secrets.token_hex(32),
+        "context": {
+            "lang": "fr_CH",
+            "tz": "Europe/Zurich",
+            "uid": uid,
+            "allowed_company_ids": [1, 2, 3],
+        },
+        "geoip": {"country_code": "CH", "city": "Lausanne"},
+        "login_date": now,
+        "last_check": now - timedelta(minutes=5),
+        "password_expiration": date.today() + timedelta(days=90),
+        "visited_menus": {101, 102, 215, 342},
+        "_trace": [],
+    }
+    if size:
+        # data stored by addons (wizards, carts, ...)
+        data["extra"] = [
+            {"id": i, "name": "line %s" % i, "date": now} for i in range(size)
+        ]
+    return data
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class SessionStoreBenchmark(object):
+    def __init__(self, store, sessions=1000, extra_size=0):
+        self.store = store
+        self.sessions = sessions
+        self.extra_size = extra_size
+        self.sids = []
+
+    def _new_session(self, uid):
+        session = self.store.session_class({}, self.store.generate_key(), True)
+        session.update(session_payload(uid, self.extra_size))
+        return session
+
+    def setup(self):
+        for uid in range(self.sessions):
+            session = self._new_session(uid + 1)
+            self.store.save(session)
+            self.sids.append(session.sid)
+
+    def teardown(self):
+        pipe = self.store.redis.pipeline(transaction=False)
+        for key in self.store.iter_keys():
+            pipe.delete(key)
+        for key in self.store.redis.scan_iter(match="%s*" % self.store.index_prefix):
+            pipe.delete(key)
+        pipe.execute()
+
+    def bytes_per_session(self):
+        sizes = [
+            len(self.store.redis.get(self.store.build_key(sid)) or b"")
+            for sid in self.sids[:100]
+        ]
+        return statistics.mean(sizes)
+
+    def _operation(self, operation, index):
+        sid = self.sids[index % len(self.sids)]
+        if operation == "get":
+            self.store.get(sid)
+        elif operation == "save":
+            session = self.store.get(sid)
+            session["last_check"] = datetime.now()
+            self.store.save(session)
+        elif operation == "save_unchanged":
+            self.store.save(self.store.get(sid))
+        elif operation == "rotate":
+            session = self.store.get(sid)
+            self.store.rotate(session, None)
+            self.sids[index % len(self.sids)] = session.sid
+        elif operation == "list":
+            for __ in self.store.list():
+                pass
+
+    def run(self, operation, concurrency, iterations):
+        """Run ``iterations`` times ``operation`` in ``concurrency`` threads
+
+        Return the throughput (operations per second) and the latencies in
+        seconds.
+        """
+
+        def worker(offset):
+            latencies = []
+            for i in range(iterations):
+                start = time.perf_counter()
+                self._operation(operation, offset + i)
+                latencies.append(time.perf_counter() - start)
+            return latencies
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(
+                executor.map(worker, [n * iterations for n in range(concurrency)])
+            )
+        elapsed = time.perf_counter() - start
+        latencies = [latency for result in results for latency in result]
+        return len(latencies) / elapsed, latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--url", default="redis://localhost:6379/15")
+    parser.add_argument(
+        "--fake", action="store_true", help="use fakeredis instead of a server"
+    )
+    parser.add_argument("--codec", default="json")
+    parser.add_argument("--compression", default=None)
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument(
+        "--extra-size",
+        type=int,
+        default=0,
+        help="number of additional records stored in each session",
+    )
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--operations", default=",".join(OPERATIONS))
+    parser.add_argument("--max-connections", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.fake:
+        client = fakeredis.FakeRedis()
+    else:
+        client = redis.Redis(
+            connection_pool=redis.ConnectionPool.from_url(
+                args.url, max_connections=args.max_connections
+            )
+        )
+    store = RedisSessionStore(
+        redis=client,
+        prefix="benchmark",
+        codec=SessionCodec(serializer=args.codec, compression=args.compression),
+        store_metrics=SessionStoreMetrics(),
+        session_class=http.Session,
+    )
+    benchmark = SessionStoreBenchmark(
+        store, sessions=args.sessions, extra_size=args.extra_size
+    )
+    benchmark.setup()
+    try:
+        sys.stdout.write(
+            "codec: %s, compression: %s, %.0f bytes per session\n"
+            % (args.codec, args.compression or "none", benchmark.bytes_per_session())
+        )
+        sys.stdout.write(
+            "%-15s %11s %12s %10s %10s\n"
+            % ("operation", "concurrency", "ops/s", "p50 ms", "p99 ms")
+        )
+        for operation in args.operations.split(","):
+            iterations = args.iterations
+            if operation == "list":
+                iterations = max(1, iterations // 100)
+            for concurrency in map(int, args.concurrency.split(",")):
+                throughput, latencies = benchmark.run(
+                    operation, concurrency, iterations
+                )
+                sys.stdout.write(
+                    "%-15s %11d %12.0f %10.3f %10.3f\n"
+                    % (
+                        operation,
+                        concurrency,
+                        throughput,
+                        percentile(latencies, 0.5) * 1000,
+                        percentile(latencies, 0.99) * 1000,
+                    )
+                )
+    finally:
+        benchmark.teardown()
+
+
+if __name__ == "__main__":
+    main()
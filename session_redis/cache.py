@@ -0,0 +1,157 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_MAX_AGE = 60  # seconds
+
+
+class SessionCache(object):
+    """Per-worker cache of the decoded sessions
+
+    The stores publish the id of a session on an invalidation channel each
+    time they write or delete it. Every worker listens to the channel in a
+    background thread and evicts the sessions written elsewhere, so a
+    session changed (or logged out) on a worker is no longer served from the
+    cache of the others.
+
+    The cache is only used while the listener is subscribed: it is emptied
+    each time the subscription is lost, as invalidations may have been
+    missed. ``max_age`` bounds the lifetime of an entry, as a safety net
+    and so that sessions expired in Redis are not kept forever.
+    """
+
+    reconnect_delay = 1
+
+    def __init__(self, size, max_age=None):
+        self.size = size
+        self.max_age = max_age or DEFAULT_CACHE_MAX_AGE
+        self._entries = OrderedDict()
+        # reads in progress, by sid, to detect an invalidation received
+        # between the read in Redis and the insertion in the cache
+        self._reading = {}
+        self._lock = threading.Lock()
+        self._listening = False
+        self._listener_pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, redis, channel):
+        """Start the invalidation listener of the current process"""
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            # new process (or first call), the thread of the parent process
+            # does not exist here
+            self._listener_pid = os.getpid()
+            self._listening = False
+            self._entries.clear()
+        thread = threading.Thread(
+            target=self._listen,
+            args=(redis, channel),
+            name="session_redis.cache_invalidation",
+            daemon=True,
+        )
+        thread.start()
+
+    def _listen(self, redis, channel):
+        while True:
+            try:
+                pubsub = redis.pubsub()
+                pubsub.subscribe(channel)
+                for message in pubsub.listen():
+                    if message["type"] == "subscribe":
+                        self._set_listening(True)
+                    elif message["type"] == "message":
+                        sid = message["data"]
+                        if isinstance(sid, bytes):
+                            sid = sid.decode("utf-8")
+                        self.invalidate(sid)
+            except Exception:
+                _logger.warning(
+                    "session cache invalidation listener disconnected, "
+                    "retrying in %ss",
+                    self.reconnect_delay,
+                    exc_info=True,
+                )
+            self._set_listening(False)
+            time.sleep(self.reconnect_delay)
+
+    def _set_listening(self, listening):
+        with self._lock:
+            self._listening = listening
+            self._entries.clear()
+            if not listening:
+                for tokens in self._reading.values():
+                    for token in tokens:
+                        token[0] = False
+
+    def begin_read(self, sid):
+        """Register a read of ``sid`` in Redis
+
+        The returned token has to be given to ``set`` or ``end_read``.
+        """
+        with self._lock:
+            token = [self._listening]
+            self._reading.setdefault(sid, []).append(token)
+        return token
+
+    def get(self, sid):
+        """Return a copy of the cached data of the session and its digest"""
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None or not self._listening:
+                self.misses += 1
+                return None
+            data, digest, deadline = entry
+            if deadline < time.monotonic():
+                del self._entries[sid]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(sid)
+            self.hits += 1
+        return copy.deepcopy(data), digest
+
+    def set(self, sid, token, data, digest):
+        """Cache the data read in Redis, unless it has been invalidated
+        since ``begin_read`` returned ``token``
+        """
+        with self._lock:
+            self._end_read(sid, token)
+            if not (token[0] and self._listening):
+                return
+            self._entries[sid] = (
+                copy.deepcopy(data),
+                digest,
+                time.monotonic() + self.max_age,
+            )
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _end_read(self, sid, token):
+        tokens = [t for t in self._reading.pop(sid, ()) if t is not token]
+        if tokens:
+            self._reading[sid] = tokens
+
+    def end_read(self, sid, token):
+        """Unregister a read of ``sid`` which is not cached"""
+        with self._lock:
+            self._end_read(sid, token)
+
+    def invalidate(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+            for token in self._reading.get(sid, ()):
+                token[0] = False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,262 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import json
+import logging
+import zlib
+from datetime import date, datetime
+
+from . import json_encoding
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # noqa
+    _logger.debug("Cannot 'import orjson'.")
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None  # noqa
+    _logger.debug("Cannot 'import msgpack'.")
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # noqa
+    _logger.debug("Cannot 'import zstandard'.")
+
+
+# Sessions written by a codec start with this header: the magic byte, the id
+# of the serializer and the id of the compression. The sessions written as
+# plain JSON (legacy format) start with "{" and are read as before.
+MAGIC = b"\x00"
+NO_COMPRESSION = b"-"
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+MSGPACK_EXT_DATETIME = 1
+MSGPACK_EXT_DATE = 2
+MSGPACK_EXT_SET = 3
+
+
+def _restore_types(obj):
+    """Recompose the date/datetime/set encoded by the JSON serializers"""
+    if isinstance(obj, dict):
+        type_ = obj.get("_type")
+        if type_ == "datetime_isoformat":
+            return datetime.fromisoformat(obj["value"])
+        elif type_ == "date_isoformat":
+            return date.fromisoformat(obj["value"])
+        elif type_ == "set":
+            return set(obj["value"])
+        return {key: _restore_types(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_restore_types(value) for value in obj]
+    return obj
+
+
+class JsonSerializer(object):
+    """Serializer of the legacy format, using the standard json module"""
+
+    name = "json"
+    ident = b"j"
+
+    def dumps(self, data):
+        return json.dumps(data, cls=json_encoding.SessionEncoder).encode("utf-8")
+
+    def loads(self, payload):
+        return json.loads(payload.decode("utf-8"), cls=json_encoding.SessionDecoder)
+
+
+class OrjsonSerializer(object):
+    """JSON serializer using orjson
+
+    The date/datetime/set values are encoded as in the legacy format.
+    """
+
+    name = "orjson"
+    ident = b"o"
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, datetime):
+            return {"_type": "datetime_isoformat", "value": obj.isoformat()}
+        elif isinstance(obj, date):
+            return {"_type": "date_isoformat", "value": obj.isoformat()}
+        elif isinstance(obj, set):
+            return {"_type": "set", "value": tuple(obj)}
+        raise TypeError
+
+    def dumps(self, data):
+        return orjson.dumps(
+            data,
+            default=self._default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+        )
+
+    def loads(self, payload):
+        return _restore_types(orjson.loads(payload))
+
+
+class MsgpackSerializer(object):
+    """Binary serializer using msgpack, with extension types for
+    date/datetime/set values
+    """
+
+    name = "msgpack"
+    ident = b"m"
+
+    @staticmethod
+    def _default(obj):
+        if isinstance(obj, datetime):
+            return msgpack.ExtType(MSGPACK_EXT_DATETIME, obj.isoformat().encode())
+        elif isinstance(obj, date):
+            return msgpack.ExtType(MSGPACK_EXT_DATE, obj.isoformat().encode())
+        elif isinstance(obj, set):
+            return msgpack.ExtType(
+                MSGPACK_EXT_SET,
+                msgpack.packb(list(obj), default=MsgpackSerializer._default),
+            )
+        raise TypeError("Cannot serialize %r" % (obj,))
+
+    @staticmethod
+    def _ext_hook(code, data):
+        if code == MSGPACK_EXT_DATETIME:
+            return datetime.fromisoformat(data.decode())
+        elif code == MSGPACK_EXT_DATE:
+            return date.fromisoformat(data.decode())
+        elif code == MSGPACK_EXT_SET:
+            return set(
+                msgpack.unpackb(
+                    data, ext_hook=MsgpackSerializer._ext_hook, strict_map_key=False
+                )
+            )
+        return msgpack.ExtType(code, data)
+
+    def dumps(self, data):
+        return msgpack.packb(data, default=self._default, use_bin_type=True)
+
+    def loads(self, payload):
+        return msgpack.unpackb(
+            payload, ext_hook=self._ext_hook, raw=False, strict_map_key=False
+        )
+
+
+class ZlibCompressor(object):
+    name = "zlib"
+    ident = b"z"
+
+    def compress(self, data):
+        return zlib.compress(data, 1)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCompressor(object):
+    name = "zstd"
+    ident = b"s"
+
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=3)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+SERIALIZERS = {
+    "json": (JsonSerializer, lambda: True),
+    "orjson": (OrjsonSerializer, lambda: orjson is not None),
+    "msgpack": (MsgpackSerializer, lambda: msgpack is not None),
+}
+COMPRESSORS = {
+    "zlib": (ZlibCompressor, lambda: True),
+    "zstd": (ZstdCompressor, lambda: zstandard is not None),
+}
+
+
+def _available(registry):
+    return {
+        cls.ident: cls() for cls, is_available in registry.values() if is_available()
+    }
+
+
+class SessionCodec(object):
+    """Encode and decode the content of the sessions stored in Redis
+
+    ``serializer`` is one of ``json``, ``orjson`` or ``msgpack`` and
+    ``compression`` one of ``zlib`` or ``zstd`` (or empty). Only the payloads
+    larger than ``compression_threshold`` bytes are compressed.
+
+    Any format known by the codec is decoded whatever the configured
+    serializer, so the serializer can be changed while sessions written with
+    the previous one are still in Redis. With the ``json`` serializer and no
+    compression, the sessions are written in the legacy format, readable by
+    the workers which do not know about codecs.
+    """
+
+    def __init__(self, serializer="json", compression=None, compression_threshold=None):
+        for name, registry in (
+            (serializer, SERIALIZERS),
+            (compression, COMPRESSORS),
+        ):
+            if not name:
+                continue
+            if name not in registry:
+                raise ValueError(
+                    "Unknown session codec '%s', available are: %s"
+                    % (name, ", ".join(registry))
+                )
+            if not registry[name][1]():
+                raise ImportError(
+                    "The python library required by the session codec '%s' "
+                    "is not installed" % (name,)
+                )
+        self.serializers = _available(SERIALIZERS)
+        self.compressors = _available(COMPRESSORS)
+        self.serializer = self.serializers[SERIALIZERS[serializer][0].ident]
+        self.compressor = None
+        if compression:
+            self.compressor = self.compressors[COMPRESSORS[compression][0].ident]
+        if compression_threshold is None:
+            compression_threshold = DEFAULT_COMPRESSION_THRESHOLD
+        self.compression_threshold = compression_threshold
+        self._legacy = isinstance(self.serializer, JsonSerializer) and not compression
+
+    def encode(self, data):
+        payload = self.serializer.dumps(data)
+        if self._legacy:
+            return payload
+        compression = NO_COMPRESSION
+        if self.compressor and len(payload) > self.compression_threshold:
+            payload = self.compressor.compress(payload)
+            compression = self.compressor.ident
+        return MAGIC + self.serializer.ident + compression + payload
+
+    def decode(self, data):
+        """Decode a session, raise a ValueError when it cannot be read"""
+        if not data.startswith(MAGIC):
+            return self.serializers[JsonSerializer.ident].loads(data)
+        serializer = self.serializers.get(data[1:2])
+        compression = data[2:3]
+        if compression == NO_COMPRESSION:
+            compressor = None
+        else:
+            compressor = self.compressors.get(compression)
+        if not serializer or (compression != NO_COMPRESSION and not compressor):
+            raise ValueError("unsupported session format %r" % (data[:3],))
+        payload = data[3:]
+        try:
+            if compressor:
+                payload = compressor.decompress(payload)
+            return serializer.loads(payload)
+        except ValueError:
+            raise
+        except Exception as err:
+            raise ValueError("session could not be decoded: %s" % (err,)) from err
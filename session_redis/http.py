@@ -1,13 +1,18 @@
 # Copyright 2016-2019 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
+import fcntl
 import logging
 import os
+import threading
+import time
 
 from odoo import http
 from odoo.tools import config
 from odoo.tools.func import lazy_property
 
+from .cache import SessionCache
+from .codec import SessionCodec
 from .session import RedisSessionStore
 from .strtobool import strtobool
 
@@ -20,6 +25,12 @@ except ImportError:
     redis = None  # noqa
     _logger.debug("Cannot 'import redis'.")
 
+try:
+    from redis.cluster import RedisCluster
+except ImportError:
+    RedisCluster = None  # noqa
+    _logger.debug("Cannot 'import redis.cluster', redis-py >= 4.1 is required.")
+
 
 def is_true(strval):
     return bool(strtobool(strval or "0".lower()))
@@ -33,6 +44,15 @@ if sentinel_host and not sentinel_master_name:
         "when using session_redis"
     )
 sentinel_port = int(os.environ.get("ODOO_SESSION_REDIS_SENTINEL_PORT", 26379))
+sentinel_read_replicas = is_true(
+    os.environ.get("ODOO_SESSION_REDIS_SENTINEL_READ_FROM_REPLICAS")
+)
+cluster = is_true(os.environ.get("ODOO_SESSION_REDIS_CLUSTER"))
+if cluster and sentinel_host:
+    raise Exception(
+        "ODOO_SESSION_REDIS_CLUSTER cannot be used with "
+        "ODOO_SESSION_REDIS_SENTINEL_HOST"
+    )
 host = os.environ.get("ODOO_SESSION_REDIS_HOST", "localhost")
 port = int(os.environ.get("ODOO_SESSION_REDIS_PORT", 6379))
 prefix = os.environ.get("ODOO_SESSION_REDIS_PREFIX")
@@ -40,37 +60,211 @@ url = os.environ.get("ODOO_SESSION_REDIS_URL")
 password = os.environ.get("ODOO_SESSION_REDIS_PASSWORD")
 expiration = os.environ.get("ODOO_SESSION_REDIS_EXPIRATION")
 anon_expiration = os.environ.get("ODOO_SESSION_REDIS_EXPIRATION_ANONYMOUS")
+refresh_threshold = os.environ.get("ODOO_SESSION_REDIS_REFRESH_THRESHOLD")
+scan_count = int(os.environ.get("ODOO_SESSION_REDIS_SCAN_COUNT", 0))
+codec = os.environ.get("ODOO_SESSION_REDIS_CODEC") or "json"
+compression = os.environ.get("ODOO_SESSION_REDIS_COMPRESSION")
+compression_threshold = os.environ.get("ODOO_SESSION_REDIS_COMPRESSION_THRESHOLD")
+cache_size = int(os.environ.get("ODOO_SESSION_REDIS_CACHE_SIZE", 0))
+cache_max_age = int(os.environ.get("ODOO_SESSION_REDIS_CACHE_MAX_AGE", 0))
+max_connections = os.environ.get("ODOO_SESSION_REDIS_MAX_CONNECTIONS")
+pool_timeout = os.environ.get("ODOO_SESSION_REDIS_POOL_TIMEOUT")
+socket_connect_timeout = os.environ.get("ODOO_SESSION_REDIS_SOCKET_CONNECT_TIMEOUT")
+socket_timeout = os.environ.get("ODOO_SESSION_REDIS_SOCKET_TIMEOUT")
+socket_keepalive = is_true(os.environ.get("ODOO_SESSION_REDIS_SOCKET_KEEPALIVE"))
+health_check_interval = int(
+    os.environ.get("ODOO_SESSION_REDIS_HEALTH_CHECK_INTERVAL", 0)
+)
+ephemeral_paths = [
+    path.strip()
+    for path in os.environ.get(
+        "ODOO_SESSION_REDIS_EPHEMERAL_PATHS",
+        "/web/static/",
+    ).split(",")
+    if path.strip()
+]
+purge_chunk_size = int(os.environ.get("ODOO_SESSION_REDIS_PURGE_CHUNK_SIZE", 1000))
+purge_pause = float(os.environ.get("ODOO_SESSION_REDIS_PURGE_PAUSE", 0.1))
 
+_store_lock = threading.Lock()
+_store = None
 
-@lazy_property
-def session_store(self):
-    if sentinel_host:
-        sentinel = Sentinel([(sentinel_host, sentinel_port)], password=password)
+
+def connection_options():
+    """Options of the connections and connection pools to Redis"""
+    options = {
+        "socket_keepalive": socket_keepalive,
+        "health_check_interval": health_check_interval,
+    }
+    if socket_connect_timeout:
+        options["socket_connect_timeout"] = float(socket_connect_timeout)
+    if socket_timeout:
+        options["socket_timeout"] = float(socket_timeout)
+    if max_connections:
+        options["max_connections"] = int(max_connections)
+    return options
+
+
+def create_redis_clients():
+    """Return the Redis client of the sessions and the one used for reads
+
+    The client used for reads is None when the sessions are read with the
+    main client.
+    """
+    options = connection_options()
+    read_client = None
+    if cluster:
+        if url:
+            redis_client = RedisCluster.from_url(url, **options)
+        else:
+            redis_client = RedisCluster(
+                host=host, port=port, password=password, **options
+            )
+    elif sentinel_host:
+        sentinel = Sentinel(
+            [(sentinel_host, sentinel_port)], password=password, **options
+        )
         redis_client = sentinel.master_for(sentinel_master_name)
-    elif url:
-        redis_client = redis.from_url(url)
+        if sentinel_read_replicas:
+            read_client = sentinel.slave_for(sentinel_master_name)
     else:
-        redis_client = redis.Redis(host=host, port=port, password=password)
+        if pool_timeout:
+            # wait for a free connection rather than opening more than
+            # max_connections
+            pool_class = redis.BlockingConnectionPool
+            options["timeout"] = float(pool_timeout)
+        else:
+            pool_class = redis.ConnectionPool
+        if url:
+            pool = pool_class.from_url(url, **options)
+        else:
+            pool = pool_class(host=host, port=port, password=password, **options)
+        redis_client = redis.Redis(connection_pool=pool)
+    return redis_client, read_client
+
+
+def get_session_store():
+    """Return the session store of the process
+
+    The store and its connection pool are shared by all the threads of the
+    process. redis-py resets the connections of the pool after a fork.
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_session_store()
+    return _store
+
+
+def create_session_store():
+    redis_client, read_client = create_redis_clients()
     return RedisSessionStore(
         redis=redis_client,
         prefix=prefix,
         expiration=expiration,
         anon_expiration=anon_expiration,
+        refresh_threshold=float(refresh_threshold) if refresh_threshold else None,
+        scan_count=scan_count,
+        codec=SessionCodec(
+            serializer=codec,
+            compression=compression,
+            compression_threshold=(
+                int(compression_threshold) if compression_threshold else None
+            ),
+        ),
+        read_redis=read_client,
+        cluster=cluster,
+        ephemeral_paths=ephemeral_paths,
+        cache=SessionCache(cache_size, max_age=cache_max_age) if cache_size else None,
         session_class=http.Session,
     )
 
 
-def purge_fs_sessions(path):
-    for fname in os.listdir(path):
-        path = os.path.join(path, fname)
+@lazy_property
+def session_store(self):
+    return get_session_store()
+
+
+def _purge_fs_dir(path, chunk_size, pause):
+    """Delete the files of ``path`` and its sub-directories
+
+    The files are deleted by chunks of ``chunk_size``, with a pause between
+    chunks to leave the disk to the workers. Return the number of deleted
+    files.
+    """
+    deleted = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    deleted += _purge_fs_dir(entry.path, chunk_size, pause)
+                    os.rmdir(entry.path)
+                    continue
+                os.unlink(entry.path)
+            except OSError:
+                _logger.warning(
+                    "OS Error during purge of %s", entry.path, exc_info=True
+                )
+                continue
+            deleted += 1
+            if not deleted % chunk_size:
+                time.sleep(pause)
+    return deleted
+
+
+def purge_fs_sessions(path, chunk_size=None, pause=None):
+    """Delete the sessions stored on the file system before Redis was used
+
+    Only one process at a time purges a directory, the others return
+    immediately.
+    """
+    if not os.path.isdir(path):
+        return 0
+    chunk_size = chunk_size or purge_chunk_size
+    pause = purge_pause if pause is None else pause
+    lock_path = "%s.purge.lock" % path.rstrip(os.sep)
+    try:
+        lock_file = open(lock_path, "w")
+    except OSError:
+        _logger.warning("Cannot open %s, sessions not purged", lock_path)
+        return 0
+    with lock_file:
         try:
-            os.unlink(path)
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
         except OSError:
-            _logger.warning("OS Error during purge of redis sessions.")
+            _logger.debug("sessions of %s are purged by another process", path)
+            return 0
+        start = time.monotonic()
+        deleted = _purge_fs_dir(path, chunk_size, pause)
+        if deleted:
+            _logger.info(
+                "purged %s file system sessions in %.1fs",
+                deleted,
+                time.monotonic() - start,
+            )
+        return deleted
+
+
+def purge_fs_sessions_in_background(path):
+    thread = threading.Thread(
+        target=purge_fs_sessions,
+        args=(path,),
+        name="session_redis.purge_fs_sessions",
+        daemon=True,
+    )
+    thread.start()
+    return thread
 
 
 if is_true(os.environ.get("ODOO_SESSION_REDIS")):
-    if sentinel_host:
+    if cluster:
+        _logger.debug(
+            "HTTP sessions stored in Redis Cluster with prefix '%s' on %s",
+            prefix or "",
+            url or "%s:%s" % (host, port),
+        )
+    elif sentinel_host:
         _logger.debug(
             "HTTP sessions stored in Redis with prefix '%s'. "
             "Using Sentinel on %s:%s",
@@ -86,5 +280,6 @@ if is_true(os.environ.get("ODOO_SESSION_REDIS")):
             port,
         )
     http.Application.session_store = session_store
-    # clean the existing sessions on the file system
-    purge_fs_sessions(config.session_dir)
+    # clean the existing sessions on the file system, without delaying the
+    # start of the server
+    purge_fs_sessions_in_background(config.session_dir)
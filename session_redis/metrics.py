@@ -0,0 +1,83 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+# events counted by the session store
+GET_HIT = "get_hit"
+GET_MISS = "get_miss"
+GET_CACHE_HIT = "get_cache_hit"
+GET_INVALID_SID = "get_invalid_sid"
+GET_DECODE_ERROR = "get_decode_error"
+GET_EPHEMERAL = "get_ephemeral"
+SAVE_WRITE = "save_write"
+SAVE_UNCHANGED = "save_unchanged"
+SAVE_EXTENDED = "save_extended"
+
+
+class SessionStoreMetrics(object):
+    """Metrics of the session stores
+
+    The store reports events (``get_hit``, ``get_miss``, ...), the latency of
+    its operations and the size of the payloads it reads and writes. They
+    are counted in memory and forwarded to the registered reporters, which
+    export them to a monitoring system. A reporter implements:
+
+    * ``event(name)``
+    * ``latency(operation, seconds)``
+    * ``payload(operation, nbytes)``
+
+    Errors raised by an operation are reported as the ``<operation>_error``
+    event.
+    """
+
+    def __init__(self):
+        self.reporters = []
+        self.events = Counter()
+        self._lock = threading.Lock()
+
+    def add_reporter(self, reporter):
+        if reporter not in self.reporters:
+            self.reporters.append(reporter)
+
+    def _report(self, method, *args):
+        for reporter in self.reporters:
+            try:
+                getattr(reporter, method)(*args)
+            except Exception:
+                _logger.debug("session metrics reporter failed", exc_info=True)
+
+    def event(self, name):
+        with self._lock:
+            self.events[name] += 1
+        if self.reporters:
+            self._report("event", name)
+
+    def payload(self, operation, nbytes):
+        if self.reporters:
+            self._report("payload", operation, nbytes)
+
+    @contextmanager
+    def timed(self, operation):
+        """Report the latency of ``operation``, or its failure"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.event("%s_error" % operation)
+            raise
+        if self.reporters:
+            self._report("latency", operation, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.events)
+
+
+session_metrics = SessionStoreMetrics()
@@ -1,18 +1,31 @@
 # Copyright 2016-2019 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
 
-import json
+import contextlib
+import hashlib
 import logging
+import time
 
+from odoo.http import request
 from odoo.service import security
 from odoo.tools._vendor.sessions import SessionStore
+from odoo.tools.lru import LRU
 
-from . import json_encoding
+from . import metrics
+from .codec import SessionCodec
 
 # this is equal to the duration of the session garbage collector in
 # odoo.http.session_gc()
 DEFAULT_SESSION_TIMEOUT = 60 * 60 * 24 * 7  # 7 days in seconds
 DEFAULT_SESSION_TIMEOUT_ANONYMOUS = 60 * 60 * 3  # 3 hours in seconds
+# number of sessions for which the digest of the content saved in redis is
+# kept in memory, to skip writing sessions which did not change
+SAVED_DIGESTS_SIZE = 8192
+# the expiration of an unchanged session is extended only when the time left
+# is below this fraction of its expiration
+DEFAULT_REFRESH_THRESHOLD = 0.5
+# number of keys redis looks at per SCAN call when listing sessions
+DEFAULT_SCAN_COUNT = 1000
 
 _logger = logging.getLogger(__name__)
 
@@ -27,33 +40,140 @@ class RedisSessionStore(SessionStore):
         prefix="",
         expiration=None,
         anon_expiration=None,
+        scan_count=None,
+        codec=None,
+        cache=None,
+        read_redis=None,
+        cluster=False,
+        store_metrics=None,
+        ephemeral_paths=None,
+        refresh_threshold=None,
     ):
         super().__init__(session_class=session_class)
         self.redis = redis
+        # client used to read the sessions, such as a replica, the writes
+        # always go to ``redis``
+        self.read_redis = read_redis
+        # ``redis`` is a RedisCluster client
+        self.cluster = cluster
+        self.metrics = store_metrics or metrics.session_metrics
+        # the requests on these paths get a session which is neither read
+        # from nor written to redis
+        self.ephemeral_paths = tuple(ephemeral_paths or ())
+        self.codec = codec or SessionCodec()
+        self.scan_count = scan_count or DEFAULT_SCAN_COUNT
         if expiration is None:
             self.expiration = DEFAULT_SESSION_TIMEOUT
         else:
-            self.expiration = expiration
+            self.expiration = int(expiration)
         if anon_expiration is None:
             self.anon_expiration = DEFAULT_SESSION_TIMEOUT_ANONYMOUS
         else:
-            self.anon_expiration = anon_expiration
+            self.anon_expiration = int(anon_expiration)
+        if refresh_threshold is None:
+            refresh_threshold = DEFAULT_REFRESH_THRESHOLD
+        self.refresh_threshold = refresh_threshold
         self.prefix = "session:"
+        # sets of the sids of each user, outside of the namespace of the
+        # sessions so they are not listed as sessions
+        self.index_prefix = "session_index:"
         if prefix:
             self.prefix = "%s:%s:" % (self.prefix, prefix)
+            self.index_prefix = "%s%s:" % (self.index_prefix, prefix)
+        # sid: (digest, expiry), the expiry (time.monotonic()) is None when
+        # it is unknown, such as for a session read from redis
+        self._saved_digests = LRU(SAVED_DIGESTS_SIZE)
+        # optional SessionCache, kept coherent between the workers by
+        # publishing the modified sessions on the invalidation channel
+        self.cache = cache
+        self.invalidation_channel = "%sinvalidation" % self.prefix
 
     def build_key(self, sid):
+        if self.cluster:
+            # hash tag: the slot of the key is computed on the sid only, so
+            # the sessions are spread on all the shards whatever the prefix
+            return "%s{%s}" % (self.prefix, sid)
         return "%s%s" % (self.prefix, sid)
 
-    def save(self, session):
-        key = self.build_key(session.sid)
+    def sid_from_key(self, key):
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        sid = key[len(self.prefix) :]
+        if self.cluster:
+            sid = sid.strip("{}")
+        return sid
+
+    def build_index_key(self, uid):
+        return "%s%s" % (self.index_prefix, uid)
+
+    @staticmethod
+    def _digest(data):
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def _remember_digest(self, sid, digest, expiration=None):
+        if expiration:
+            expiry = time.monotonic() + expiration
+        else:
+            previous = self._saved_digests.get(sid)
+            # keep the known expiry of a session read after its write
+            expiry = previous[1] if previous and previous[0] == digest else None
+        self._saved_digests[sid] = (digest, expiry)
 
+    def _forget_digest(self, sid):
+        with contextlib.suppress(KeyError):
+            del self._saved_digests[sid]
+
+    def _get_expiration(self, session):
         # allow to set a custom expiration for a session
         # such as a very short one for monitoring requests
         if session.uid:
-            expiration = session.expiration or self.expiration
-        else:
-            expiration = session.expiration or self.anon_expiration
+            return session.expiration or self.expiration
+        return session.expiration or self.anon_expiration
+
+    def _is_ephemeral_request(self):
+        if not self.ephemeral_paths or not request:
+            return False
+        return request.httprequest.path.startswith(self.ephemeral_paths)
+
+    def _encode(self, session):
+        return self.codec.encode(dict(session))
+
+    def _invalidate(self, pipe, *sids):
+        """Add the publication of the invalidation of ``sids`` to ``pipe``"""
+        if self.cache is None:
+            return
+        for sid in sids:
+            self.cache.invalidate(sid)
+            if self.cluster:
+                # PUBLISH cannot be pipelined on a cluster, the message is
+                # propagated to every node whichever receives it
+                self.redis.publish(
+                    self.invalidation_channel, sid, target_nodes=self.redis.RANDOM
+                )
+            else:
+                pipe.publish(self.invalidation_channel, sid)
+
+    def _index(self, pipe, session, expiration):
+        """Add the sid of the session to the index of its user in ``pipe``
+
+        The index lives as long as the longest session it may contain,
+        its expiration is extended with the sessions of the user.
+        """
+        if not session.uid:
+            return
+        index_key = self.build_index_key(session.uid)
+        pipe.sadd(index_key, session.sid)
+        pipe.expire(index_key, max(expiration, self.expiration))
+
+    def save(self, session):
+        with self.metrics.timed("save"):
+            return self._save(session)
+
+    def _save(self, session):
+        if self._is_ephemeral_request():
+            return False
+        key = self.build_key(session.sid)
+        expiration = self._get_expiration(session)
         if _logger.isEnabledFor(logging.DEBUG):
             if session.uid:
                 user_msg = "user '%s' (id: %s)" % (session.login, session.uid)
@@ -66,56 +186,234 @@ class RedisSessionStore(SessionStore):
                 user_msg,
             )
 
-        data = json.dumps(dict(session), cls=json_encoding.SessionEncoder).encode(
-            "utf-8"
-        )
-        if self.redis.set(key, data):
-            return self.redis.expire(key, expiration)
+        data = self._encode(session)
+        digest = self._digest(data)
+        saved_digest, expiry = self._saved_digests.get(session.sid) or (None, None)
+        if saved_digest == digest:
+            # same content as in redis, its expiration is extended only when
+            # it comes near, so active sessions do not cause a write on
+            # every request
+            threshold = expiration * self.refresh_threshold
+            if expiry and expiry - time.monotonic() > threshold:
+                self.metrics.event(metrics.SAVE_UNCHANGED)
+                return True
+            self.metrics.event(metrics.SAVE_EXTENDED)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.expire(key, expiration)
+            self._index(pipe, session, expiration)
+            if pipe.execute()[0]:
+                self._remember_digest(session.sid, digest, expiration)
+                return True
+            # the session expired in redis in the meantime, write it again
+            self._forget_digest(session.sid)
+        self.metrics.event(metrics.SAVE_WRITE)
+        self.metrics.payload("save", len(data))
+        # a single atomic command for the value and its expiration
+        if self.cache is None and not session.uid:
+            saved = self.redis.set(key, data, ex=expiration)
+        else:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.set(key, data, ex=expiration)
+            self._index(pipe, session, expiration)
+            self._invalidate(pipe, session.sid)
+            saved = pipe.execute()[0]
+        if saved:
+            self._remember_digest(session.sid, digest, expiration)
+            return True
+        return False
 
     def delete(self, session):
+        with self.metrics.timed("delete"):
+            return self._delete(session)
+
+    def _delete(self, session):
         key = self.build_key(session.sid)
         _logger.debug("deleting session with key %s", key)
-        return self.redis.delete(key)
+        self._forget_digest(session.sid)
+        if self.cache is None and not session.uid:
+            return self.redis.delete(key)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.delete(key)
+        if session.uid:
+            pipe.srem(self.build_index_key(session.uid), session.sid)
+        self._invalidate(pipe, session.sid)
+        return pipe.execute()[0]
+
+    def _read(self, key):
+        if self.read_redis is not None:
+            try:
+                saved = self.read_redis.get(key)
+            except Exception:
+                _logger.warning(
+                    "session with key '%s' could not be read on the replica, "
+                    "reading it on the master",
+                    key,
+                    exc_info=True,
+                )
+            else:
+                if saved:
+                    return saved
+                # not replicated yet or really missing: the master knows
+        return self.redis.get(key)
 
     def get(self, sid):
+        with self.metrics.timed("get"):
+            return self._get(sid)
+
+    def _get(self, sid):
         if not self.is_valid_key(sid):
+            self.metrics.event(metrics.GET_INVALID_SID)
             _logger.debug(
                 "session with invalid sid '%s' has been asked, " "returning a new one",
                 sid,
             )
             return self.new()
+        if self._is_ephemeral_request():
+            self.metrics.event(metrics.GET_EPHEMERAL)
+            # keep the sid, so the cookie of the browser is not replaced
+            return self.session_class({}, sid, False)
+
+        token = None
+        if self.cache is not None:
+            self.cache.start(self.redis, self.invalidation_channel)
+            cached = self.cache.get(sid)
+            if cached:
+                self.metrics.event(metrics.GET_CACHE_HIT)
+                data, digest = cached
+                self._remember_digest(sid, digest)
+                return self.session_class(data, sid, False)
+            token = self.cache.begin_read(sid)
 
         key = self.build_key(sid)
-        saved = self.redis.get(key)
+        try:
+            saved = self._read(key)
+        except Exception:
+            if token is not None:
+                self.cache.end_read(sid, token)
+            raise
         if not saved:
+            self.metrics.event(metrics.GET_MISS)
+            if token is not None:
+                self.cache.end_read(sid, token)
             _logger.debug(
                 "session with non-existent key '%s' has been asked, "
                 "returning a new one",
                 key,
             )
             return self.new()
+        self.metrics.event(metrics.GET_HIT)
+        self.metrics.payload("get", len(saved))
+        digest = self._digest(saved)
+        self._remember_digest(sid, digest)
         try:
-            data = json.loads(saved.decode("utf-8"), cls=json_encoding.SessionDecoder)
+            data = self.codec.decode(saved)
         except ValueError:
+            self.metrics.event(metrics.GET_DECODE_ERROR)
             _logger.debug(
-                "session for key '%s' has been asked but its json "
+                "session for key '%s' has been asked but its "
                 "content could not be read, it has been reset",
                 key,
             )
             data = {}
+            if token is not None:
+                self.cache.end_read(sid, token)
+                token = None
+        if token is not None:
+            self.cache.set(sid, token, data, digest)
         return self.session_class(data, sid, False)
 
+    def iter_keys(self, pattern="*"):
+        """Iterate over the keys of the sessions matching ``pattern``
+
+        The keys are read with ``SCAN`` by batches of about ``scan_count``
+        keys, so redis is never blocked and the keys are never all loaded
+        in memory. A key may be returned more than once.
+        """
+        return self.redis.scan_iter(
+            match="%s%s" % (self.prefix, pattern), count=self.scan_count
+        )
+
     def list(self):
-        keys = self.redis.keys("%s*" % self.prefix)
+        """Iterate over the session ids (lazily)"""
         _logger.debug("a listing redis keys has been called")
-        return [key[len(self.prefix) :] for key in keys]
+        for key in self.iter_keys():
+            yield self.sid_from_key(key)
+
+    def _index_members(self, index_key):
+        return [
+            sid.decode("utf-8") if isinstance(sid, bytes) else sid
+            for sid in self.redis.smembers(index_key)
+        ]
+
+    def user_sids(self, uid):
+        """Return the ids of the sessions of a user
+
+        The sessions which expired or were logged out are removed from the
+        index.
+        """
+        index_key = self.build_index_key(uid)
+        sids = self._index_members(index_key)
+        if not sids:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for sid in sids:
+            pipe.exists(self.build_key(sid))
+        alive = [sid for sid, exists in zip(sids, pipe.execute()) if exists]
+        expired = set(sids) - set(alive)
+        if expired:
+            self.redis.srem(index_key, *expired)
+        return alive
+
+    def delete_user_sessions(self, uid, keep_sid=None):
+        """Delete all the sessions of a user, except ``keep_sid``
+
+        Used to log out a user everywhere, for instance after a change of
+        password or when the user is archived. Return the number of deleted
+        sessions.
+        """
+        index_key = self.build_index_key(uid)
+        sids = self._index_members(index_key)
+        sids = [sid for sid in sids if sid != keep_sid]
+        if not sids:
+            return 0
+        pipe = self.redis.pipeline(transaction=False)
+        for sid in sids:
+            self._forget_digest(sid)
+            pipe.delete(self.build_key(sid))
+        pipe.srem(index_key, *sids)
+        self._invalidate(pipe, *sids)
+        deleted = sum(pipe.execute()[: len(sids)])
+        _logger.info("deleted %s sessions of user %s", deleted, uid)
+        return deleted
 
     def rotate(self, session, env):
-        self.delete(session)
+        with self.metrics.timed("rotate"):
+            return self._rotate(session, env)
+
+    def _rotate(self, session, env):
+        if self._is_ephemeral_request():
+            return
+        old_sid = session.sid
+        old_key = self.build_key(old_sid)
+        self._forget_digest(old_sid)
         session.sid = self.generate_key()
         if session.uid and env:
             session.session_token = security.compute_session_token(session, env)
-        self.save(session)
+        key = self.build_key(session.sid)
+        _logger.debug("rotating session with key %s to %s", old_key, key)
+        data = self._encode(session)
+        self.metrics.payload("rotate", len(data))
+        # delete and save in a single round trip
+        pipe = self.redis.pipeline()
+        pipe.delete(old_key)
+        expiration = self._get_expiration(session)
+        pipe.set(key, data, ex=expiration)
+        if session.uid:
+            pipe.srem(self.build_index_key(session.uid), old_sid)
+            self._index(pipe, session, expiration)
+        self._invalidate(pipe, old_sid)
+        pipe.execute()
+        self._remember_digest(session.sid, self._digest(data), expiration)
 
     def vacuum(self, *args, **kwargs):
         """Do not garbage collect the sessions
@@ -0,0 +1,168 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import fnmatch
+import functools
+import queue
+from collections import defaultdict
+
+
+class ListenerClosed(BaseException):
+    """Stop the listener of a SessionCache
+
+    Not an Exception, so the listener does not catch it to reconnect.
+    """
+
+
+def command(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self._in_pipeline:
+            self.requests.append(method.__name__)
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        def queue_command(*args, **kwargs):
+            self.commands.append((name, method, args, kwargs))
+            return self
+
+        return queue_command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        self.redis.requests.append(tuple(name for name, *__ in commands))
+        self.redis._in_pipeline = True
+        try:
+            return [method(*args, **kwargs) for __, method, args, kwargs in commands]
+        finally:
+            self.redis._in_pipeline = False
+
+
+class FakePubSub(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.queue = queue.Queue()
+
+    def subscribe(self, channel):
+        self.redis.subscribers[channel].append(self.queue)
+        self.queue.put({"type": "subscribe", "channel": channel, "data": 1})
+
+    def listen(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                self.queue.task_done()
+                raise ListenerClosed()
+            yield message
+            # the message has been handled by the listener
+            self.queue.task_done()
+
+
+class FakeRedis(object):
+    """In-memory replacement of a ``redis.Redis`` client
+
+    Implements the subset of the commands used by the session store. The
+    requests sent to the server are recorded in ``requests``: the name of
+    the command, or the tuple of the names of the commands of a pipeline.
+    The keys never expire, their expiration is kept in ``ttls``.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.sets = defaultdict(set)
+        self.ttls = {}
+        self.requests = []
+        self.published = []
+        self.subscribers = defaultdict(list)
+        self._in_pipeline = False
+
+    def _exists(self, key):
+        return key in self.values or bool(self.sets.get(key))
+
+    @command
+    def get(self, key):
+        return self.values.get(key)
+
+    @command
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+        self.ttls[key] = ex
+        return True
+
+    @command
+    def expire(self, key, seconds):
+        if not self._exists(key):
+            return False
+        self.ttls[key] = seconds
+        return True
+
+    @command
+    def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._exists(key):
+                deleted += 1
+            self.values.pop(key, None)
+            self.sets.pop(key, None)
+            self.ttls.pop(key, None)
+        return deleted
+
+    @command
+    def exists(self, *keys):
+        return sum(1 for key in keys if self._exists(key))
+
+    @command
+    def sadd(self, key, *members):
+        added = {member.encode() for member in members} - self.sets[key]
+        self.sets[key] |= added
+        return len(added)
+
+    @command
+    def srem(self, key, *members):
+        removed = {member.encode() for member in members} & self.sets[key]
+        self.sets[key] -= removed
+        return len(removed)
+
+    @command
+    def smembers(self, key):
+        return set(self.sets.get(key, ()))
+
+    @command
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+        for subscriber in self.subscribers[channel]:
+            subscriber.put({"type": "message", "channel": channel, "data": message})
+        return len(self.subscribers[channel])
+
+    def scan_iter(self, match="*", count=None):
+        keys = list(self.values) + [key for key in self.sets if self.sets[key]]
+        for key in keys:
+            if fnmatch.fnmatchcase(key, match):
+                yield key.encode()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+    def wait_delivered(self):
+        """Wait until the published messages have been handled"""
+        for subscribers in self.subscribers.values():
+            for subscriber in subscribers:
+                subscriber.join()
+
+    def close_subscribers(self):
+        for subscribers in self.subscribers.values():
+            for subscriber in subscribers:
+                subscriber.put(None)
@@ -0,0 +1,109 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import json
+import unittest
+from datetime import date, datetime
+
+from odoo.tests.common import BaseCase
+
+from odoo.addons.session_redis import codec
+from odoo.addons.session_redis.codec import SessionCodec
+from odoo.addons.session_redis.json_encoding import SessionEncoder
+
+SESSION = {
+    "db": "odoo",
+    "uid": 2,
+    "login": "admin",
+    "context": {"lang": "en_US", "tz": "Europe/Zurich", "uid": 2},
+    "login_date": datetime(2026, 3, 14, 15, 9, 26, 535),
+    "password_expiration": date(2026, 6, 1),
+    "visited_menus": {101, 102},
+    "extra": [{"id": i, "name": "line %s" % i} for i in range(100)],
+}
+
+
+def available_codecs():
+    """(serializer, compression) of the codecs usable here"""
+    serializers = ["json"]
+    if codec.orjson:
+        serializers.append("orjson")
+    if codec.msgpack:
+        serializers.append("msgpack")
+    compressions = [None, "zlib"]
+    if codec.zstandard:
+        compressions.append("zstd")
+    return [
+        (serializer, compression)
+        for serializer in serializers
+        for compression in compressions
+    ]
+
+
+class TestSessionCodec(BaseCase):
+    def test_legacy_output(self):
+        """The default codec writes the legacy format byte for byte"""
+        legacy = json.dumps(SESSION, cls=SessionEncoder).encode("utf-8")
+        self.assertEqual(SessionCodec().encode(SESSION), legacy)
+        self.assertEqual(SessionCodec(serializer="json").encode(SESSION), legacy)
+
+    def test_decode_legacy(self):
+        """The sessions written in the legacy format are read by any codec"""
+        legacy = json.dumps(SESSION, cls=SessionEncoder).encode("utf-8")
+        for serializer, compression in available_codecs():
+            with self.subTest(serializer=serializer, compression=compression):
+                session_codec = SessionCodec(
+                    serializer=serializer, compression=compression
+                )
+                self.assertEqual(session_codec.decode(legacy), SESSION)
+
+    def test_cross_codec(self):
+        """A session written by a codec is read by all the others"""
+        codecs = available_codecs()
+        for serializer, compression in codecs:
+            encoder = SessionCodec(
+                serializer=serializer,
+                compression=compression,
+                compression_threshold=0,
+            )
+            data = encoder.encode(SESSION)
+            for read_serializer, read_compression in codecs:
+                with self.subTest(
+                    written=(serializer, compression),
+                    read=(read_serializer, read_compression),
+                ):
+                    decoder = SessionCodec(
+                        serializer=read_serializer, compression=read_compression
+                    )
+                    self.assertEqual(decoder.decode(data), SESSION)
+
+    def test_compression_threshold(self):
+        session_codec = SessionCodec(compression="zlib", compression_threshold=10000)
+        self.assertEqual(session_codec.encode(SESSION)[:3], b"\x00j-")
+        session_codec = SessionCodec(compression="zlib", compression_threshold=10)
+        self.assertEqual(session_codec.encode(SESSION)[:3], b"\x00jz")
+
+    def test_unknown_header(self):
+        session_codec = SessionCodec()
+        with self.assertRaises(ValueError):
+            session_codec.decode(b'\x00x-{"uid": 2}')
+        with self.assertRaises(ValueError):
+            session_codec.decode(b'\x00jx{"uid": 2}')
+
+    def test_malformed_payload(self):
+        session_codec = SessionCodec()
+        for data in (b"\x00jz not compressed", b'\x00j-{"uid": ', b'{"uid": '):
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    session_codec.decode(data)
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            SessionCodec(serializer="pickle")
+        with self.assertRaises(ValueError):
+            SessionCodec(compression="lzma")
+
+    @unittest.skipIf(codec.msgpack, "msgpack is installed")
+    def test_missing_library(self):
+        with self.assertRaises(ImportError):
+            SessionCodec(serializer="msgpack")
@@ -0,0 +1,459 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+
+import contextlib
+import os
+import threading
+import time
+from unittest.mock import patch
+
+from odoo import http
+from odoo.tests.common import BaseCase
+
+from odoo.addons.session_redis import cache as cache_module
+from odoo.addons.session_redis import session as session_module
+from odoo.addons.session_redis.cache import SessionCache
+from odoo.addons.session_redis.metrics import SessionStoreMetrics
+from odoo.addons.session_redis.session import RedisSessionStore
+
+from .fake_redis import FakeRedis, ListenerClosed
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class SessionStoreCase(BaseCase):
+    expiration = 1000
+    anon_expiration = 100
+
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        patcher = patch.object(session_module, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis = FakeRedis()
+        self.store = self._new_store()
+
+    def _new_store(self, **kwargs):
+        return RedisSessionStore(
+            redis=self.redis,
+            expiration=self.expiration,
+            anon_expiration=self.anon_expiration,
+            store_metrics=SessionStoreMetrics(),
+            session_class=http.Session,
+            **kwargs
+        )
+
+    def _new_session(self, store=None, **data):
+        store = store or self.store
+        session = store.new()
+        session.update(data)
+        return session
+
+    def _saved(self, sid, store=None):
+        store = store or self.store
+        data = self.redis.values.get(store.build_key(sid))
+        return data and store.codec.decode(data)
+
+
+class TestRedisSessionStore(SessionStoreCase):
+    def test_save_anonymous(self):
+        """An anonymous session is saved with a single SET"""
+        session = self._new_session(context={"lang": "en_US"})
+        self.assertTrue(self.store.save(session))
+        self.assertEqual(self.redis.requests, ["set"])
+        key = self.store.build_key(session.sid)
+        self.assertEqual(self.redis.ttls[key], self.anon_expiration)
+        self.assertEqual(self._saved(session.sid), {"context": {"lang": "en_US"}})
+
+    def test_save_user(self):
+        """The session of a user is saved and indexed in one round trip"""
+        session = self._new_session(uid=2, login="admin")
+        self.assertTrue(self.store.save(session))
+        self.assertEqual(self.redis.requests, [("set", "sadd", "expire")])
+        key = self.store.build_key(session.sid)
+        self.assertEqual(self.redis.ttls[key], self.expiration)
+        self.assertEqual(self._saved(session.sid), {"uid": 2, "login": "admin"})
+
+    def test_save_unchanged(self):
+        """A session saved with the same content is not written again"""
+        session = self._new_session(uid=2)
+        self.store.save(session)
+        self.redis.requests.clear()
+        self.assertTrue(self.store.save(session))
+        self.assertFalse(self.redis.requests)
+        self.assertEqual(self.store.metrics.events["save_unchanged"], 1)
+        # same for the session read again in another request
+        session = self.store.get(session.sid)
+        self.redis.requests.clear()
+        self.assertTrue(self.store.save(session))
+        self.assertFalse(self.redis.requests)
+
+    def test_save_changed(self):
+        session = self._new_session(uid=2)
+        self.store.save(session)
+        session = self.store.get(session.sid)
+        session["context"] = {"lang": "fr_CH"}
+        self.redis.requests.clear()
+        self.assertTrue(self.store.save(session))
+        self.assertEqual(self.redis.requests, [("set", "sadd", "expire")])
+        self.assertEqual(self._saved(session.sid)["context"], {"lang": "fr_CH"})
+
+    def test_save_unknown_digest(self):
+        """A session whose digest is unknown is written"""
+        session = self._new_session(uid=2)
+        self.store.save(session)
+        other_store = self._new_store()
+        self.redis.requests.clear()
+        self.assertTrue(other_store.save(session))
+        self.assertEqual(self.redis.requests, [("set", "sadd", "expire")])
+
+    def test_get(self):
+        session = self._new_session(uid=2, login="admin")
+        self.store.save(session)
+        read = self.store.get(session.sid)
+        self.assertEqual(read.sid, session.sid)
+        self.assertEqual(dict(read), {"uid": 2, "login": "admin"})
+        self.assertFalse(read.is_new)
+
+    def test_get_missing(self):
+        sid = self.store.generate_key()
+        session = self.store.get(sid)
+        self.assertTrue(session.is_new)
+        self.assertNotEqual(session.sid, sid)
+        self.assertEqual(self.store.metrics.events["get_miss"], 1)
+
+    def test_get_unreadable(self):
+        sid = self.store.generate_key()
+        self.redis.values[self.store.build_key(sid)] = b"\x00x-garbage"
+        session = self.store.get(sid)
+        self.assertEqual(session.sid, sid)
+        self.assertEqual(dict(session), {})
+        self.assertEqual(self.store.metrics.events["get_decode_error"], 1)
+
+    def test_delete(self):
+        session = self._new_session()
+        self.store.save(session)
+        self.store.delete(session)
+        self.assertFalse(self.redis.values)
+        # saved again after a delete, even if the content is the same
+        self.redis.requests.clear()
+        self.store.save(session)
+        self.assertEqual(self.redis.requests, ["set"])
+
+    def test_rotate(self):
+        session = self._new_session(uid=2, login="admin")
+        self.store.save(session)
+        old_sid = session.sid
+        self.redis.requests.clear()
+        self.store.rotate(session, None)
+        self.assertNotEqual(session.sid, old_sid)
+        # the old key is deleted and the new one written in one round trip
+        self.assertEqual(len(self.redis.requests), 1)
+        self.assertIsNone(self._saved(old_sid))
+        self.assertEqual(self._saved(session.sid), {"uid": 2, "login": "admin"})
+        key = self.store.build_key(session.sid)
+        self.assertEqual(self.redis.ttls[key], self.expiration)
+        # the content written by the rotation is known
+        self.redis.requests.clear()
+        self.store.save(session)
+        self.assertFalse(self.redis.requests)
+
+    def test_rotate_anonymous(self):
+        session = self._new_session()
+        self.store.save(session)
+        old_sid = session.sid
+        self.store.rotate(session, None)
+        self.assertIsNone(self._saved(old_sid))
+        self.assertEqual(self._saved(session.sid), {})
+        key = self.store.build_key(session.sid)
+        self.assertEqual(self.redis.ttls[key], self.anon_expiration)
+
+    def test_list(self):
+        sids = set()
+        for uid in (2, 3, False):
+            session = self._new_session(uid=uid)
+            self.store.save(session)
+            sids.add(session.sid)
+        # the indexes of the users are not listed as sessions
+        self.assertEqual(set(self.store.list()), sids)
+
+
+class TestSessionRefresh(SessionStoreCase):
+    """Expiration of the unchanged sessions (threshold of 0.5 by default)"""
+
+    def _save_and_wait(self, seconds, **data):
+        session = self._new_session(**data)
+        self.store.save(session)
+        key = self.store.build_key(session.sid)
+        # the ttl in redis as it will be after the wait
+        self.redis.ttls[key] -= seconds
+        self.clock.advance(seconds)
+        self.redis.requests.clear()
+        return session
+
+    def test_refresh_below_threshold(self):
+        """Nothing is sent while more than the threshold is left"""
+        session = self._save_and_wait(400, uid=2)
+        self.assertTrue(self.store.save(session))
+        self.assertFalse(self.redis.requests)
+        self.assertEqual(self.store.metrics.events["save_unchanged"], 1)
+
+    def test_refresh_expire(self):
+        """Past the threshold, the expiration is extended without a write"""
+        session = self._save_and_wait(600, uid=2)
+        self.assertTrue(self.store.save(session))
+        self.assertEqual(self.redis.requests, [("expire", "sadd", "expire")])
+        key = self.store.build_key(session.sid)
+        self.assertEqual(self.redis.ttls[key], self.expiration)
+        self.assertEqual(self.store.metrics.events["save_extended"], 1)
+        # the new expiry is known, the next saves are skipped again
+        self.redis.requests.clear()
+        self.clock.advance(100)
+        self.store.save(session)
+        self.assertFalse(self.redis.requests)
+
+    def test_refresh_anonymous(self):
+        session = self._save_and_wait(60)
+        self.store.save(session)
+        self.assertEqual(self.redis.requests, [("expire",)])
+        key = self.store.build_key(session.sid)
+        self.assertEqual(self.redis.ttls[key], self.anon_expiration)
+
+    def test_refresh_unknown_expiry(self):
+        """A session read from redis has an unknown expiry, it is extended"""
+        session = self._new_session(uid=2)
+        self.store.save(session)
+        other_store = self._new_store()
+        session = other_store.get(session.sid)
+        self.redis.requests.clear()
+        self.assertTrue(other_store.save(session))
+        self.assertEqual(self.redis.requests, [("expire", "sadd", "expire")])
+        self.redis.requests.clear()
+        other_store.save(session)
+        self.assertFalse(self.redis.requests)
+
+    def test_refresh_expired(self):
+        """The session expired in redis in the meantime, it is written"""
+        session = self._save_and_wait(600, context={"lang": "en_US"})
+        del self.redis.values[self.store.build_key(session.sid)]
+        self.assertTrue(self.store.save(session))
+        self.assertEqual(self.redis.requests, [("expire",), "set"])
+        self.assertEqual(self._saved(session.sid), {"context": {"lang": "en_US"}})
+        self.redis.requests.clear()
+        self.store.save(session)
+        self.assertFalse(self.redis.requests)
+
+    def test_refresh_changed(self):
+        """A changed session is written whatever the time left"""
+        session = self._save_and_wait(10, uid=2)
+        session["context"] = {"lang": "fr_CH"}
+        self.assertTrue(self.store.save(session))
+        self.assertEqual(self.redis.requests, [("set", "sadd", "expire")])
+        self.assertEqual(self.store.metrics.events["save_write"], 2)
+
+
+class TestUserIndex(SessionStoreCase):
+    def _index(self, uid):
+        return {
+            sid.decode() for sid in self.redis.sets[self.store.build_index_key(uid)]
+        }
+
+    def _save_user_sessions(self, uid, count):
+        sessions = []
+        for __ in range(count):
+            session = self._new_session(uid=uid)
+            self.store.save(session)
+            sessions.append(session)
+        return sessions
+
+    def test_index(self):
+        sessions = self._save_user_sessions(2, 2)
+        self._save_user_sessions(3, 1)
+        self._save_user_sessions(False, 1)
+        self.assertEqual(
+            set(self.store.user_sids(2)), {session.sid for session in sessions}
+        )
+        self.assertEqual(len(self.store.user_sids(3)), 1)
+        self.assertEqual(self.store.user_sids(4), [])
+        # the index lives as long as the sessions
+        index_key = self.store.build_index_key(2)
+        self.assertEqual(self.redis.ttls[index_key], self.expiration)
+
+    def test_index_cleanup(self):
+        """The sessions expired in redis are removed from the index"""
+        sessions = self._save_user_sessions(2, 3)
+        del self.redis.values[self.store.build_key(sessions[0].sid)]
+        alive = {session.sid for session in sessions[1:]}
+        self.assertEqual(set(self.store.user_sids(2)), alive)
+        self.assertEqual(self._index(2), alive)
+
+    def test_index_rotate(self):
+        session = self._save_user_sessions(2, 1)[0]
+        old_sid = session.sid
+        self.store.rotate(session, None)
+        self.assertEqual(self._index(2), {session.sid})
+        self.assertNotIn(old_sid, self.store.user_sids(2))
+
+    def test_index_delete(self):
+        sessions = self._save_user_sessions(2, 2)
+        self.store.delete(sessions[0])
+        self.assertEqual(self._index(2), {sessions[1].sid})
+        self.assertEqual(self.store.user_sids(2), [sessions[1].sid])
+
+    def test_delete_user_sessions(self):
+        sessions = self._save_user_sessions(2, 3)
+        other = self._save_user_sessions(3, 1)[0]
+        keep = sessions[0]
+        self.assertEqual(self.store.delete_user_sessions(2, keep_sid=keep.sid), 2)
+        for session in sessions[1:]:
+            self.assertIsNone(self._saved(session.sid))
+        self.assertEqual(self._index(2), {keep.sid})
+        self.assertEqual(self.store.user_sids(2), [keep.sid])
+        self.assertEqual(self.store.user_sids(3), [other.sid])
+        # a deleted session saved again by a running request is written
+        self.redis.requests.clear()
+        self.store.save(sessions[1])
+        self.assertEqual(self.redis.requests, [("set", "sadd", "expire")])
+        self.assertEqual(self.store.delete_user_sessions(2), 2)
+        self.assertEqual(self.store.user_sids(2), [])
+        self.assertEqual(self.store.delete_user_sessions(2), 0)
+
+
+class TestSessionCache(SessionStoreCase):
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(cache_module, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = self._start_cache()
+        self.store = self._new_store(cache=self.cache)
+
+    def _start_cache(self, size=10):
+        """Return a cache listening to the invalidations, as in a worker"""
+        cache = SessionCache(size)
+        # the listener is run here, SessionCache.start() does not start one
+        cache._listener_pid = os.getpid()
+
+        def listen():
+            with contextlib.suppress(ListenerClosed):
+                cache._listen(self.redis, self.store.invalidation_channel)
+
+        thread = threading.Thread(target=listen, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(self.redis.close_subscribers)
+        deadline = time.monotonic() + 5
+        while not cache._listening and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(cache._listening)
+        return cache
+
+    def _saved_session(self, **data):
+        session = self._new_session(**data)
+        self.store.save(session)
+        self.redis.wait_delivered()
+        # read once to put it in the cache
+        self.store.get(session.sid)
+        self.redis.requests.clear()
+        return session
+
+    def test_cache_hit(self):
+        session = self._saved_session(uid=2, context={"lang": "en_US"})
+        read = self.store.get(session.sid)
+        self.assertFalse(self.redis.requests)
+        self.assertEqual(dict(read), {"uid": 2, "context": {"lang": "en_US"}})
+        self.assertEqual(self.store.metrics.events["get_cache_hit"], 1)
+        # the cached data is not modified through the session
+        read["context"]["lang"] = "fr_CH"
+        self.assertEqual(self.store.get(session.sid)["context"], {"lang": "en_US"})
+        # the digest is known, the session is not written again
+        self.store.save(self.store.get(session.sid))
+        self.assertFalse(self.redis.requests)
+
+    def test_cache_max_age(self):
+        session = self._saved_session(uid=2)
+        self.clock.advance(cache_module.DEFAULT_CACHE_MAX_AGE - 1)
+        self.store.get(session.sid)
+        self.assertFalse(self.redis.requests)
+        self.clock.advance(2)
+        self.store.get(session.sid)
+        self.assertEqual(self.redis.requests, ["get"])
+
+    def test_cache_size(self):
+        sessions = [self._saved_session(uid=uid) for uid in range(1, 12)]
+        # the least recently used session has been evicted
+        self.store.get(sessions[0].sid)
+        self.assertEqual(self.redis.requests, ["get"])
+        self.redis.requests.clear()
+        self.store.get(sessions[-1].sid)
+        self.assertFalse(self.redis.requests)
+
+    def test_evict_on_save(self):
+        session = self._saved_session(uid=2)
+        session["context"] = {"lang": "fr_CH"}
+        self.store.save(session)
+        self.assertIn(
+            (self.store.invalidation_channel, session.sid), self.redis.published
+        )
+        self.redis.wait_delivered()
+        self.redis.requests.clear()
+        read = self.store.get(session.sid)
+        self.assertEqual(self.redis.requests, ["get"])
+        self.assertEqual(read["context"], {"lang": "fr_CH"})
+
+    def test_evict_on_delete(self):
+        session = self._saved_session(uid=2)
+        self.store.delete(session)
+        self.redis.wait_delivered()
+        read = self.store.get(session.sid)
+        self.assertTrue(read.is_new)
+
+    def test_evict_on_rotate(self):
+        session = self._saved_session(uid=2)
+        old_sid = session.sid
+        self.store.rotate(session, None)
+        self.redis.wait_delivered()
+        self.assertTrue(self.store.get(old_sid).is_new)
+
+    def test_invalidation_message(self):
+        """A session written by another worker is evicted from the cache"""
+        other_store = self._new_store(cache=self._start_cache())
+        session = self._saved_session(uid=2)
+        other_session = other_store.get(session.sid)
+        other_session["context"] = {"lang": "fr_CH"}
+        other_store.save(other_session)
+        self.redis.wait_delivered()
+        self.redis.requests.clear()
+        read = self.store.get(session.sid)
+        self.assertEqual(self.redis.requests, ["get"])
+        self.assertEqual(read["context"], {"lang": "fr_CH"})
+        # deleted by the other worker
+        other_store.delete(other_session)
+        self.redis.wait_delivered()
+        self.assertTrue(self.store.get(session.sid).is_new)
+
+    def test_invalidation_during_read(self):
+        """A session invalidated while it is read in redis is not cached"""
+        sid = self.store.generate_key()
+        token = self.cache.begin_read(sid)
+        self.cache.invalidate(sid)
+        self.cache.set(sid, token, {"uid": 2}, b"digest")
+        self.assertIsNone(self.cache.get(sid))
+
+    def test_not_listening(self):
+        """The cache is not used while the invalidations may be missed"""
+        session = self._saved_session(uid=2)
+        self.cache._set_listening(False)
+        self.store.get(session.sid)
+        self.store.get(session.sid)
+        self.assertEqual(self.redis.requests, ["get", "get"])